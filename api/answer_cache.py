@@ -0,0 +1,103 @@
+# api/answer_cache.py
+"""
+Disk-backed cache of generated answers (SQLite).
+
+Answers are keyed on a SHA-256 of the model name and the final prompt, so the
+same concept with the same textbook excerpt is generated once and then served
+from disk. Entries expire after ANSWER_CACHE_TTL seconds, and the least
+recently used ones are deleted once the stored answers exceed
+ANSWER_CACHE_MAX_MB. Each call opens its own connection, so the cache can be
+used from several request threads at once.
+"""
+import hashlib
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from .config import ANSWER_CACHE_PATH, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_MB
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used);
+"""
+STATS = {"hits": 0, "misses": 0}
+
+
+@contextmanager
+def _connect():
+    """Yields a connection inside a transaction (committed on success) and closes it afterwards."""
+    connection = sqlite3.connect(ANSWER_CACHE_PATH, timeout=5)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL") # Readers do not block the writer
+        connection.executescript(SCHEMA)
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def answer_key(model_name, prompt):
+    return hashlib.sha256(f"{model_name}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+def get_answer(key):
+    """Returns the cached response for key, or None if missing or expired."""
+    try:
+        with _connect() as connection:
+            row = connection.execute("SELECT response FROM answers WHERE key = ? AND created > ?",
+                                     (key, time.time() - ANSWER_CACHE_TTL)).fetchone()
+            if row:
+                connection.execute("UPDATE answers SET last_used = ? WHERE key = ?", (time.time(), key))
+    except sqlite3.Error as e:
+        print(f"Answer cache read error: {e}")
+        return None
+    STATS["hits" if row else "misses"] += 1
+    return row[0] if row else None
+
+
+def put_answer(key, model_name, response):
+    """Stores a response, then drops expired entries and least recently used ones beyond ANSWER_CACHE_MAX_MB."""
+    now = time.time()
+    size = len(response.encode("utf-8"))
+    try:
+        with _connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                               (key, model_name, response, size, now, now))
+            connection.execute("DELETE FROM answers WHERE created <= ?", (now - ANSWER_CACHE_TTL,))
+            excess = connection.execute("SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()[0] - ANSWER_CACHE_MAX_MB * 1024 * 1024
+            if excess > 0:
+                evicted = []
+                for evicted_key, evicted_size in connection.execute("SELECT key, size FROM answers ORDER BY last_used"):
+                    if excess <= 0:
+                        break
+                    evicted.append((evicted_key,))
+                    excess -= evicted_size
+                connection.executemany("DELETE FROM answers WHERE key = ?", evicted)
+    except sqlite3.Error as e:
+        print(f"Answer cache write error: {e}")
+
+
+def purge_answers():
+    """Deletes every cached answer and returns how many there were."""
+    with _connect() as connection:
+        count = connection.execute("DELETE FROM answers").rowcount
+    with _connect() as connection:
+        connection.execute("VACUUM") # Give the space back to the disk
+    return count
+
+
+def answer_cache_stats():
+    """Returns hit/miss counters (this process) and the number and size of stored answers."""
+    try:
+        with _connect() as connection:
+            entries, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answers").fetchone()
+    except sqlite3.Error as e:
+        return {**STATS, "error": str(e)}
+    return {**STATS, "entries": entries, "size_mb": round(size / (1024 * 1024), 2), "max_mb": ANSWER_CACHE_MAX_MB}
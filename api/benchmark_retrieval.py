@@ -0,0 +1,186 @@
+# api/benchmark_retrieval.py
+"""
+Speed and relevance benchmark for textbook retrieval.
+
+    python -m api.benchmark_retrieval [--engines phrase bm25 ...] [--output run.json] [--baseline old.json]
+
+Runs every case of benchmark_cases.json (textbook_id, query, expected_pages taken
+from the textbooks' own section page spans) through each retrieval engine and
+reports per engine:
+
+    p50/p99 latency   over all cases x --repeat runs, indexes already loaded
+    peak memory       tracemalloc peak while answering every case once
+    recall@k, hit@k   share of expected pages in the top k, and share of cases with any
+    context size      characters (and characters / 4 as estimated tokens) sent to the model
+
+plus the time and memory needed to load the indexes. --output saves the report as
+JSON; --baseline compares the run against such a file.
+
+tests/test_retrieval_benchmark.py runs the bm25 engine over the same cases and
+fails if its recall@5 or hit@5 falls below the measured level.
+"""
+import argparse
+import json
+import math
+import os
+import time
+import tracemalloc
+
+from .config import SEARCH_TOP_K
+from .textbook_processor import TEXTBOOK_CACHE, TEXTBOOK_CACHE_LOCK, available_textbooks, build_context, get_text_from_pages, \
+    get_textbook_content, get_tfidf_index, rank_concept_pages, route_concept, search_concept_pages
+from .tfidf_index import TFIDF_AVAILABLE
+
+CASES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_cases.json")
+CHARS_PER_TOKEN = 4 # Rough estimate used for the context budget as well
+
+
+def phrase_engine(textbook_id, query, top_k):
+    """The original lookup: every page holding the exact phrase, in page order, pasted in full."""
+    pages = search_concept_pages(textbook_id, query)
+    return pages[:top_k], get_text_from_pages(textbook_id, pages)
+
+
+def bm25_engine(textbook_id, query, top_k):
+    ranked_pages = rank_concept_pages(textbook_id, query, top_k, mode="bm25")
+    return [page_number for page_number, _ in ranked_pages], build_context(textbook_id, query, ranked_pages)[0]
+
+
+def tfidf_engine(textbook_id, query, top_k):
+    ranked_pages = rank_concept_pages(textbook_id, query, top_k, mode="tfidf")
+    return [page_number for page_number, _ in ranked_pages], build_context(textbook_id, query, ranked_pages)[0]
+
+
+def routed_engine(textbook_id, query, top_k):
+    """A general request: the textbook is not given and must be found by routing."""
+    pages = []
+    context_parts = []
+    for book_id, ranked_pages in route_concept(query, top_k):
+        if book_id == textbook_id:
+            pages = [page_number for page_number, _ in ranked_pages]
+        context_parts.append(build_context(book_id, query, ranked_pages)[0])
+    return pages, "\n\n".join(context_parts)
+
+
+ENGINES = {
+    "phrase": phrase_engine,
+    "bm25": bm25_engine,
+    "tfidf": tfidf_engine,
+    "routed": routed_engine,
+}
+
+
+def load_cases(filepath=CASES_FILE):
+    with open(filepath, 'r') as infile:
+        return json.load(infile)
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def load_indexes():
+    """Loads every textbook index (and the TF-IDF index when available); returns (seconds, memory in KB)."""
+    with TEXTBOOK_CACHE_LOCK:
+        TEXTBOOK_CACHE.clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    for textbook_id in available_textbooks():
+        get_textbook_content(textbook_id)
+    if TFIDF_AVAILABLE:
+        get_tfidf_index()
+    seconds = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, memory / 1024
+
+
+def run_engine(engine, cases, top_k=SEARCH_TOP_K, repeat=5):
+    """Runs every case through `engine` and returns its metrics."""
+    # One traced pass for memory and relevance; tracing slows Python down, so timings come from separate runs
+    tracemalloc.start()
+    results = [engine(case["textbook_id"], case["query"], top_k) for case in cases]
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = []
+    for _ in range(repeat):
+        for case in cases:
+            start = time.perf_counter()
+            engine(case["textbook_id"], case["query"], top_k)
+            timings.append((time.perf_counter() - start) * 1000)
+
+    recalls, hits, context_chars = [], [], []
+    for case, (pages, context_text) in zip(cases, results):
+        found = set(case["expected_pages"]) & set(pages[:top_k])
+        recalls.append(len(found) / len(case["expected_pages"]))
+        hits.append(1.0 if found else 0.0)
+        context_chars.append(len(context_text))
+
+    mean_chars = sum(context_chars) / len(cases)
+    return {
+        "p50_ms": round(percentile(timings, 50), 3),
+        "p99_ms": round(percentile(timings, 99), 3),
+        "peak_memory_kb": round(peak_memory / 1024, 1),
+        f"recall@{top_k}": round(sum(recalls) / len(cases), 3),
+        f"hit@{top_k}": round(sum(hits) / len(cases), 3),
+        "context_chars": round(mean_chars),
+        "context_tokens": round(mean_chars / CHARS_PER_TOKEN),
+        "max_context_chars": max(context_chars),
+    }
+
+
+def run_benchmark(engine_names, cases, top_k=SEARCH_TOP_K, repeat=5):
+    load_seconds, load_memory = load_indexes()
+    report = {"cases": len(cases), "top_k": top_k, "repeat": repeat,
+              "load": {"seconds": round(load_seconds, 3), "memory_kb": round(load_memory, 1)}, "engines": {}}
+    for engine_name in engine_names:
+        if engine_name == "tfidf" and not get_tfidf_index():
+            print("Skipping tfidf: numpy or tfidf.npz is missing (build it with preprocess_textbooks --tfidf).")
+            continue
+        report["engines"][engine_name] = run_engine(ENGINES[engine_name], cases, top_k, repeat)
+    return report
+
+
+def print_report(report, baseline=None):
+    """Prints one row per engine; with a baseline report, each value is followed by its change."""
+    def cell(value, old_value):
+        if old_value is None:
+            return f"{value}"
+        change = value - old_value
+        return f"{value} ({'+' if change >= 0 else ''}{round(change, 3)})"
+
+    print(f"{report['cases']} cases, top_k={report['top_k']}, {report['repeat']} timed runs each")
+    old_load = (baseline or {}).get("load", {})
+    print(f"load: {cell(report['load']['seconds'], old_load.get('seconds'))} s, "
+          f"{cell(report['load']['memory_kb'], old_load.get('memory_kb'))} KB")
+    for engine_name, metrics in report["engines"].items():
+        old_metrics = (baseline or {}).get("engines", {}).get(engine_name, {})
+        print(f"{engine_name}: " + ", ".join(f"{metric}={cell(value, old_metrics.get(metric))}" for metric, value in metrics.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark textbook retrieval speed and relevance.")
+    parser.add_argument("--engines", nargs="+", choices=list(ENGINES), default=list(ENGINES))
+    parser.add_argument("--cases", default=CASES_FILE, help="JSON list of {textbook_id, query, expected_pages}")
+    parser.add_argument("--top-k", type=int, default=SEARCH_TOP_K)
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    parser.add_argument("--output", help="save the report as JSON")
+    parser.add_argument("--baseline", help="report JSON of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.engines, load_cases(args.cases), args.top_k, args.repeat)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as infile:
+            baseline = json.load(infile)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=4)
+
+
+if __name__ == "__main__":
+    main()
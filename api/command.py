@@ -1,21 +1,24 @@
 # api/command.py
 from time import sleep
 import time # Import time module for sleep
-import google.generativeai as genai
 # import re # No longer needed as answer_exercise is removed
 
 from .auth import is_admin
-from .config import ALLOWED_USERS,IS_DEBUG_MODE,GOOGLE_API_KEY
+from .config import ALLOWED_USERS,IS_DEBUG_MODE,GOOGLE_API_KEY,CONTEXT_MAX_CHARS,ROUTE_GENERAL_REQUESTS
 from .printLog import send_log
-from .telegram import send_message
-from .textbook_processor import get_textbook_content, search_concept_pages, get_text_from_pages # Keep for other commands
-from .gemini import generate_content, generate_content_stream
+from .dispatcher import queue_message, DISPATCHER
+from .streaming import start_reply
+from .textbook_processor import get_textbook_content, textbook_cache_stats, retrieval_cache_stats, cached_retrieval, rank_concept_pages, route_concept, build_context, correct_concept, available_textbooks # Keep for other commands
+from .gemini import generate_content, generate_content_stream, warm_up, KEY_POOL
+from .answer_cache import answer_cache_stats, purge_answers
+from .telegram_files import file_cache_stats
 
 admin_auch_info = "You are not the administrator or your administrator ID is set incorrectly!!!"
 debug_mode_info = "Debug mode is not enabled!"
 STREAMING_OUTPUT_SENT = "STREAMING_OUTPUT_SENT" # Marker for streaming functions
 
 DEFAULT_TEXTBOOK_ID = "general" # Used when no textbook is specified
+TEXTBOOK_ALIASES = {"eco9": "economics9", "hist9": "history9", "bio9": "biology9", "chem9": "chemistry9", "phy9": "physics9"}
 
 def help():
     help_text = "Welcome to Gemini 2.0 flash AI! Interact through text or images and experience insightful answers. Unlock the power of AI-driven communication – every message is a chance for a smarter exchange. Send text or image!\n Experience the power of AI-driven communication through insightful answers, text, or images. \n👾 Features \n Answer any question, even challenging or strange ones. \n ⏩ Generate creative text formats like poems, scripts, code, emails, and more. \n ⏩ Translate languages effortlessly. \n ⏩ Simplify complex concepts with clear explanations. \n ⏩  Perform math and calculations. \n ⏩ Assist with research and creative content generation. \n ⏩ Provide fun with word games, quizzes, and much more!\n ⏩ Send a text or image and unlock smarter exchanges. Don’t forget to join the channels below for more: And most importantly join the channels:  \n [Channel 1](https://t.me/+gOUK4JnBcCtkYWQ8) \n [Channel 2](https://t.me/telegemin). \n ወደ ጀሚኒ 1.5 ፕሮ አርቴፊሻል ኢንተለጀንስ እንኳን ደህና መጡ! ድንቅ 3 ከፍተኛ ተጠቃሚዎች ያሉት ጎግል AI ፣ እኔ እዚህ ስፍር ቁጥር በሌላቸው መንገዶች ልረዳችሁ የምችል የአርቴፊሻል ኢንተለጀንስ ቻት ቦት ነኝ። በአስተዋይ መልሶች、 በጽሑፍ ወይም በምስሎች የአርቴፊሻል ኢንተለጀንስ የተጎላበተ የግንኙነት ይለማመዱ። \n \n ⏩ ማንኛውንም ጥያቄ、 ፈታኝ ወይም እንግዳ የሆኑትንም እንኳ መልስ ያግኙ። \n ⏩ እንደ ግጥም、 ስክሪፕት、 ኮድ、 ኢሜይሎች እና ሌሎችም ያሉ የፈጠራ ጽሑፎችን ይፍጠሩ። \n ⏩ ቋንቋዎችን በቀላሉ መተርጎም። \n ⏩ ውስብስብ ጽንሰ-ሐሳቦችን በግልጽ ማብራራት። \n ⏩ የሂሳብ ስሌቶችን መስራት። \n ⏩ በምርምር እና በፈጠራ ይዘት ያላቸው ፅሁፎች። \n ⏩ በቃላት ጨዋታዎች、 ጥያቄዎች እና በብዙ ተጨማሪ ነገሮች ይዝናኑ!\n ⏩ ጽሑፍ ወይም ምስል ይላኩ እና መልስ ያግኙ። ለተጨማሪ መረጃ ከታች ባሉት ቻናሎች መቀላቀልዎን አይርሱ።"
@@ -40,19 +43,14 @@ def _parse_args_concept_topic_textbook(args_str: str, command_name: str, item_na
         )
 
     args_parts = args_str.strip().split()
-    item_phrase = ""
+    item_phrase = " ".join(args_parts)
     textbook_id = DEFAULT_TEXTBOOK_ID
 
-    if len(args_parts) == 1:
-        item_phrase = args_parts[0]
-    elif len(args_parts) > 1:
-        last_part = args_parts[-1]
-        if (last_part.isalnum() and any(c.isalpha() for c in last_part)) or \
-           last_part.lower() in ["eco9", "hist9", "bio9", "chem9", "phy9", "economics9", "history9", "biology9", "physics9", "chemistry9", "general"]:
+    if len(args_parts) > 1: # The last word is a textbook ID only if such a textbook exists ("/explain cell division" is one concept)
+        last_part = TEXTBOOK_ALIASES.get(args_parts[-1].lower(), args_parts[-1].lower())
+        if last_part == DEFAULT_TEXTBOOK_ID or last_part in available_textbooks():
             textbook_id = last_part
             item_phrase = " ".join(args_parts[:-1])
-        else:
-            item_phrase = " ".join(args_parts) 
 
     if not item_phrase: 
         return None, None, f"The {item_name} cannot be empty. Please try again."
@@ -60,10 +58,61 @@ def _parse_args_concept_topic_textbook(args_str: str, command_name: str, item_na
     return item_phrase.strip(), textbook_id.lower(), None
 
 
+def _ranked_context(textbook_id, concept):
+    """
+    Ranks textbook pages for a concept and packs their best passages into the context budget.
+    General requests are routed across every textbook. Returns (context_text, sources, best_score), where
+    sources reads like "pages 42, 147 of the textbook 'biology9'" and is "" when nothing matched.
+    """
+    if textbook_id == DEFAULT_TEXTBOOK_ID:
+        book_pages = route_concept(concept) if ROUTE_GENERAL_REQUESTS == "1" else []
+    else:
+        book_pages = [(textbook_id, rank_concept_pages(textbook_id, concept))]
+
+    context_parts = []
+    sources = []
+    remaining = CONTEXT_MAX_CHARS
+    for book_id, ranked_pages in book_pages:
+        context_text, used_pages, dropped_pages = build_context(book_id, concept, ranked_pages, max_chars=remaining)
+        if dropped_pages:
+            send_log(f"Ranked pages left out of the context for '{concept}' ({book_id}): {', '.join(map(str, dropped_pages))}")
+        if used_pages:
+            context_parts.append(context_text if len(book_pages) == 1 else f"[Textbook '{book_id}']\n{context_text}")
+            sources.append(f"pages {', '.join(map(str, sorted(used_pages)))} of the textbook '{book_id}'")
+            remaining -= len(context_parts[-1]) + 2
+    best_score = max((score for _, ranked_pages in book_pages for _, score in ranked_pages), default=0.0)
+    return "\n\n".join(context_parts), " and ".join(sources), best_score
+
+
+def _search_textbooks(textbook_id, concept):
+    """
+    Like _ranked_context, but retries with misspelled words corrected against the textbook vocabulary
+    and keeps whichever search scores better. Returns (context_text, sources, corrected_concept or None).
+    """
+    context_text, sources, best_score = _ranked_context(textbook_id, concept)
+    if textbook_id == DEFAULT_TEXTBOOK_ID and ROUTE_GENERAL_REQUESTS != "1":
+        return context_text, sources, None
+
+    corrected_concept = correct_concept(concept, available_textbooks() if textbook_id == DEFAULT_TEXTBOOK_ID else [textbook_id])
+    if corrected_concept != concept:
+        corrected_context, corrected_sources, corrected_score = _ranked_context(textbook_id, corrected_concept)
+        if corrected_sources and corrected_score > best_score:
+            return corrected_context, corrected_sources, corrected_concept
+    return context_text, sources, None
+
+
+def _textbook_context(textbook_id, concept):
+    """Cached _search_textbooks for popular concepts. Returns (context_text, sources, searched_concept)."""
+    searched_textbooks = available_textbooks() if textbook_id == DEFAULT_TEXTBOOK_ID else [textbook_id]
+    context_text, sources, corrected_concept = cached_retrieval(textbook_id, concept, searched_textbooks, _search_textbooks)
+    return context_text, sources, corrected_concept or concept
+
+
 def list_models():
     models_info = []
-    if genai: 
+    if warm_up(): # Loads and configures the Gemini SDK on first use
         try:
+            import google.generativeai as genai
             for m in genai.list_models():
                 if 'generateContent' in m.supported_generation_methods:
                     models_info.append(m.name)
@@ -82,13 +131,34 @@ def get_allowed_users():
     return ""
 
 
+def get_cache_stats():
+    textbook_stats = textbook_cache_stats()
+    retrieval_stats = retrieval_cache_stats()
+    answer_stats = answer_cache_stats()
+    file_stats = file_cache_stats()
+    outbox_stats = DISPATCHER.stats()
+    # Replied directly, so it also works with debug mode off
+    return (f"Textbook cache:\n```json\n{textbook_stats}```\nRetrieval cache:\n```json\n{retrieval_stats}```\n"
+            f"Answer cache:\n```json\n{answer_stats}```\nPhoto cache:\n```json\n{file_stats}```\n"
+            f"Outgoing messages:\n```json\n{outbox_stats}```")
+
+
+def purge_answer_cache():
+    try:
+        purged = purge_answers()
+    except Exception as e:
+        return f"Failed to purge the answer cache: {e}"
+    send_log(f"Answer cache purged ({purged} answers).")
+    return f"Answer cache purged ({purged} answers)."
+
+
 def get_API_key():
     send_log(f"GOOGLE_API_KEY (first key displayed):\n```\n{GOOGLE_API_KEY[0] if GOOGLE_API_KEY else 'Not Set'}```")
+    send_log(f"Gemini key pool ({len(KEY_POOL.keys)} keys):\n```json\n{KEY_POOL.stats()}```")
     return ""
 
 def speed_test(chat_id): 
-    send_message(chat_id, "开始测速...")
-    time.sleep(2)
+    queue_message(chat_id, "开始测速...")
     simulated_speed = int(time.time() * 1000) % 50000 + 10000 
     return f"测试完成，您的5G速度大约为：\n**{simulated_speed} B/s**"
 
@@ -108,33 +178,32 @@ def send_message_test(admin_chat_id, command_full_text):
         return f"Invalid target user ID: '{to_id_str}'. ID must be a number."
         
     try:
-        send_message(to_id_str, text_to_send)
-        send_log(f"Admin {admin_chat_id} sent message to {to_id_str}: '{text_to_send}'")
-        return f"Message sent to {to_id_str}." 
+        queue_message(int(to_id_str), text_to_send)
+        send_log(f"Admin {admin_chat_id} queued a message to {to_id_str}: '{text_to_send}'")
+        return f"Message to {to_id_str} queued for delivery." # Sent by the outbox; failures show in its logs
     except Exception as e:
-        send_log(f"Error sending message from admin {admin_chat_id} to {to_id_str}: {e}")
-        return f"Failed to send message to {to_id_str}. Error: {e}"
+        send_log(f"Error queuing message from admin {admin_chat_id} to {to_id_str}: {e}")
+        return f"Failed to queue the message to {to_id_str}. Error: {e}"
 
 
 def explain_concept(from_id, concept, textbook_id):
-    """Explains concept with streaming, using time-based chunk buffering and robust error handling."""
+    """Explains concept with streaming (see api/streaming.py) and robust error handling."""
     context_text = ""
     page_refs_text = ""
     prompt = ""
     full_response_for_log = ""
     
     is_general_request = textbook_id.lower() == DEFAULT_TEXTBOOK_ID
-    concept_pages = []
-    if not is_general_request:
-        concept_pages = search_concept_pages(textbook_id, concept)
+    context_text, sources, searched_concept = _textbook_context(textbook_id, concept) # General requests are routed to the best textbook(s)
+    spelling_note = f"Searched for '{searched_concept}' instead of '{concept}'. " if searched_concept != concept else ""
+    concept = searched_concept
 
-    if concept_pages:
-        context_text = get_text_from_pages(textbook_id, concept_pages)
-        page_refs_text = f"(Explanation based on pages from '{textbook_id}': {', '.join(map(str, concept_pages))})"
+    if sources:
+        page_refs_text = f"({spelling_note}Explanation based on {sources})"
         prompt = (
             f"You are a helpful AI Tutor for Grade 9 students. "
-            f"Explain the concept of '{concept}' based on the following excerpt from pages {', '.join(map(str, concept_pages))} "
-            f"of the textbook '{textbook_id}':\n\n---\n{context_text}\n---\n\n"
+            f"Explain the concept of '{concept}' based on the following excerpt from "
+            f"{sources}:\n\n---\n{context_text}\n---\n\n"
             f"Provide a detailed and comprehensive explanation suitable for a Grade 9 student. "
             f"Use simple language, analogies if helpful, and structure your explanation clearly, perhaps with bullet points for key aspects."
         )
@@ -155,36 +224,23 @@ def explain_concept(from_id, concept, textbook_id):
         page_refs_text = "(General explanation provided, no specific textbook context used.)"
 
 
-    response_stream = generate_content_stream(prompt)
-    buffered_message = ""
-    last_chunk_time = time.time()
+    response_stream = generate_content_stream(prompt, use_cache=True)
+    reply = start_reply(from_id) # One message edited in place, or chunks (STREAM_MODE)
 
     try:
         for chunk_text in response_stream:
             if chunk_text:
-                buffered_message += chunk_text
-                full_response_for_log += chunk_text
-
-            current_time = time.time()
-            time_since_last_chunk = current_time - last_chunk_time
-
-            if len(buffered_message) >= 3500 or (buffered_message.strip() and time_since_last_chunk >= 3): 
-                if buffered_message.strip():
-                    send_message(from_id, buffered_message)
-                buffered_message = ""
-                last_chunk_time = current_time
-                time.sleep(0.2) 
+                reply.append(chunk_text)
     except Exception as e:
         error_message = f"Error during streaming explanation from Gemini: {e}"
         send_log(f"Streaming error for explain_concept ('{concept}', {textbook_id}): {e}")
-        send_message(from_id, error_message)
-        return STREAMING_OUTPUT_SENT 
+        reply.finish(f"\n\n{error_message}" if reply.full_text else error_message)
+        return STREAMING_OUTPUT_SENT
 
-    if buffered_message.strip():
-        send_message(from_id, buffered_message)
+    full_response_for_log = reply.finish()
     
     if page_refs_text: 
-         send_message(from_id, page_refs_text)
+        queue_message(from_id, page_refs_text)
     
     send_log(f"Full explanation for '{concept}' ({textbook_id}) by user {from_id}:\n{full_response_for_log}\n{page_refs_text}")
     return STREAMING_OUTPUT_SENT
@@ -198,17 +254,16 @@ def create_questions(from_id, concept, textbook_id):
     full_response_for_log = ""
 
     is_general_request = textbook_id.lower() == DEFAULT_TEXTBOOK_ID
-    concept_pages = []
-    if not is_general_request:
-        concept_pages = search_concept_pages(textbook_id, concept)
+    context_text, sources, searched_concept = _textbook_context(textbook_id, concept) # General requests are routed to the best textbook(s)
+    spelling_note = f"Searched for '{searched_concept}' instead of '{concept}'. " if searched_concept != concept else ""
+    concept = searched_concept
 
-    if concept_pages:
-        context_text = get_text_from_pages(textbook_id, concept_pages)
-        page_refs_text = f"(Questions based on pages from '{textbook_id}': {', '.join(map(str, concept_pages))})"
+    if sources:
+        page_refs_text = f"({spelling_note}Questions based on {sources})"
         prompt = (
             f"You are an AI Quiz Generator for Grade 9 students. "
-            f"Generate 10-15 review questions about the concept of '{concept}' based on the provided text from pages "
-            f"{', '.join(map(str, concept_pages))} of the textbook '{textbook_id}':\n\n---\n{context_text}\n---\n\n"
+            f"Generate 10-15 review questions about the concept of '{concept}' based on the provided text from "
+            f"{sources}:\n\n---\n{context_text}\n---\n\n"
             f"These questions should test understanding for Grade 9 level. Include a mix of types: "
             f"~5-7 multiple choice (with 4 distinct options A, B, C, D), "
             f"~3-4 true/false, and ~2-3 short answer. "
@@ -231,37 +286,24 @@ def create_questions(from_id, concept, textbook_id):
         )
         page_refs_text = "(General questions provided, no specific textbook context used.)"
 
-    response_stream = generate_content_stream(prompt) 
-    buffered_message = ""
-    last_chunk_time = time.time()
+    response_stream = generate_content_stream(prompt, use_cache=True) 
+    reply = start_reply(from_id) # One message edited in place, or chunks (STREAM_MODE)
 
     try:
         for chunk_text in response_stream:
             if chunk_text:
-                buffered_message += chunk_text
-                full_response_for_log += chunk_text
-
-            current_time = time.time()
-            time_since_last_chunk = current_time - last_chunk_time
-
-            if len(buffered_message) >= 3500 or (buffered_message.strip() and time_since_last_chunk >= 3):
-                if buffered_message.strip():
-                    send_message(from_id, buffered_message)
-                buffered_message = ""
-                last_chunk_time = current_time
-                time.sleep(0.2)
+                reply.append(chunk_text)
     except Exception as e:
         error_message = f"Error during streaming question generation: {e}"
         send_log(f"Streaming error for create_questions ('{concept}', {textbook_id}): {e}")
-        send_message(from_id, error_message)
+        reply.finish(f"\n\n{error_message}" if reply.full_text else error_message)
         return STREAMING_OUTPUT_SENT
 
-    if buffered_message.strip():
-        send_message(from_id, buffered_message)
-        
-    if page_refs_text:
-        send_message(from_id, page_refs_text)
-
+    full_response_for_log = reply.finish()
+    
+    if page_refs_text: 
+        queue_message(from_id, page_refs_text)
+    
     send_log(f"Full questions for '{concept}' ({textbook_id}) by user {from_id}:\n{full_response_for_log}\n{page_refs_text}")
     return STREAMING_OUTPUT_SENT
 
@@ -272,17 +314,16 @@ def prepare_short_note(from_id, topic, textbook_id):
     page_refs_text = ""
     
     is_general_request = textbook_id.lower() == DEFAULT_TEXTBOOK_ID
-    topic_pages = []
-    if not is_general_request:
-        topic_pages = search_concept_pages(textbook_id, topic)
+    context_text, sources, searched_topic = _textbook_context(textbook_id, topic) # General requests are routed to the best textbook(s)
+    spelling_note = f"Searched for '{searched_topic}' instead of '{topic}'. " if searched_topic != topic else ""
+    topic = searched_topic
 
-    if topic_pages:
-        context_text = get_text_from_pages(textbook_id, topic_pages)
-        page_refs_text = f"(Note based on pages from '{textbook_id}': {', '.join(map(str, topic_pages))})"
+    if sources:
+        page_refs_text = f"({spelling_note}Note based on {sources})"
         prompt = (
             f"You are an AI Study Assistant for Grade 9 students. "
             f"Prepare a concise but comprehensive study note on the topic of '{topic}', drawing from the provided text "
-            f"from pages {', '.join(map(str, topic_pages))} of the textbook '{textbook_id}'. "
+            f"from {sources}. "
             f"Focus on 5-7 key points, definitions, and important concepts. Make it easy to understand. Use bullet points for clarity.\n\n"
             f"---\n{context_text}\n---"
         )
@@ -302,7 +343,7 @@ def prepare_short_note(from_id, topic, textbook_id):
         )
         page_refs_text = "(General note provided, no specific textbook context used.)"
 
-    response = generate_content(prompt) 
+    response = generate_content(prompt, use_cache=True) 
     return f"{response}\n\n{page_refs_text}"
 
 
@@ -323,10 +364,10 @@ def excute_command(from_id, command_full_text):
     elif command_name == "send_message": 
         return send_message_test(from_id, command_full_text) 
     
-    elif command_name in ["get_allowed_users", "get_api_key", "list_models"]:
+    elif command_name in ["get_allowed_users", "get_api_key", "list_models", "cache_stats", "purge_answer_cache"]:
         if not is_admin(from_id):
             return admin_auch_info
-        if IS_DEBUG_MODE == "0" and command_name != "list_models": 
+        if IS_DEBUG_MODE == "0" and command_name not in ["list_models", "cache_stats", "purge_answer_cache"]: 
             return debug_mode_info
         
         if command_name == "get_allowed_users":
@@ -335,6 +376,10 @@ def excute_command(from_id, command_full_text):
             return get_API_key() 
         elif command_name == "list_models":
             return list_models() 
+        elif command_name == "cache_stats":
+            return get_cache_stats()
+        elif command_name == "purge_answer_cache":
+            return purge_answer_cache()
 
     elif command_name == "explain":
         concept, textbook_id, error_msg = _parse_args_concept_topic_textbook(args_str, command_name, "concept")
@@ -19,6 +19,92 @@ CHANNEL_ID = os.getenv("CHANNEL_ID","-1002238005293")
 #Determines whether to verify identity. If 0, anyone can use the bot. It is enabled by default.
 AUCH_ENABLE = os.getenv("AUCH_ENABLE", "0")
 
+#Maximum number of best-ranked textbook pages used as context for /explain, /note and /create_questions.
+SEARCH_TOP_K = int(os.getenv("SEARCH_TOP_K", "5"))
+#Page ranking for textbook commands: "bm25" (exact terms) or "tfidf" (character n-grams, also matches partial words; needs numpy and api/textbook_index/tfidf.npz, built with "python -m api.preprocess_textbooks --from-json --tfidf" before deploying).
+SEARCH_MODE = os.getenv("SEARCH_MODE", "bm25").lower()
+#Character budget for the textbook excerpt pasted into those prompts (roughly 4 characters per token).
+CONTEXT_MAX_CHARS = int(os.getenv("CONTEXT_MAX_CHARS", "8000"))
+#Characters kept on each side of a matched term when trimming a page down to passages.
+CONTEXT_WINDOW_CHARS = int(os.getenv("CONTEXT_WINDOW_CHARS", "500"))
+#When no textbook ID is given, search every textbook and ground the answer in the best matching one(s). 1 to enable.
+ROUTE_GENERAL_REQUESTS = os.getenv("ROUTE_GENERAL_REQUESTS", "1")
+#Most textbooks a routed request may draw from, and how close (as a fraction of the best book's score) another book must be to be included.
+ROUTE_MAX_BOOKS = int(os.getenv("ROUTE_MAX_BOOKS", "2"))
+ROUTE_MIN_SCORE_RATIO = float(os.getenv("ROUTE_MIN_SCORE_RATIO", "0.6"))
+#Memory budget in MB for loaded textbook indexes; the least recently used textbook is evicted beyond it. All eight take about 0.5 MB memory-mapped, about 50 MB from JSON.
+TEXTBOOK_CACHE_MAX_MB = float(os.getenv("TEXTBOOK_CACHE_MAX_MB", "96"))
+#Textbook IDs to load in the background at startup, comma separated, or "all". Empty loads every textbook on first use.
+TEXTBOOK_PRELOAD = [textbook_id for textbook_id in split(r'[ ,;，；]+', os.getenv("TEXTBOOK_PRELOAD", '').lower()) if textbook_id]
+#How many textbooks' spelling correctors to keep loaded (memory-mapped, a few KB of heap each); general questions consult every textbook.
+SPELLING_CACHE_SIZE = int(os.getenv("SPELLING_CACHE_SIZE", "8"))
+#How many textbook searches (concept -> excerpt and page list) to remember, and for how many seconds.
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "1024"))
+RETRIEVAL_CACHE_TTL = int(os.getenv("RETRIEVAL_CACHE_TTL", "3600"))
+#Reuse generated /explain, /note and /create_questions answers for identical prompts. 1 to enable.
+ANSWER_CACHE_ENABLE = os.getenv("ANSWER_CACHE_ENABLE", "1")
+#SQLite file for cached answers (/tmp is the writable directory on Vercel), how long answers stay valid in seconds, and the size limit in MB.
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "/tmp/answer_cache.sqlite3")
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+ANSWER_CACHE_MAX_MB = float(os.getenv("ANSWER_CACHE_MAX_MB", "50"))
+#Seconds a Gemini API key rests after a 429/quota error (doubles on repeated errors). Requests move to the other keys of GOOGLE_API_KEY meanwhile.
+GEMINI_KEY_COOLDOWN = float(os.getenv("GEMINI_KEY_COOLDOWN", "60"))
+#Deadlines in seconds for one Gemini request, and for a whole streamed answer. They include every retry and API key failover.
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))
+GEMINI_STREAM_TIMEOUT = float(os.getenv("GEMINI_STREAM_TIMEOUT", "120"))
+#Retries of a Gemini request after a timeout or a 500/503 error (with randomized exponential backoff).
+GEMINI_RETRIES = int(os.getenv("GEMINI_RETRIES", "2"))
+#After this many failed Gemini requests in a row, answer with an error at once for GEMINI_BREAKER_RESET seconds instead of waiting on Gemini.
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))
+GEMINI_BREAKER_RESET = float(os.getenv("GEMINI_BREAKER_RESET", "30"))
+#Chat turns (a message and its reply) resent verbatim with every chat message. Older turns are folded into a running summary. 0 keeps the whole history.
+CHAT_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_TURNS", "6"))
+#Maximum length of that summary in characters (roughly 4 characters per token).
+CHAT_SUMMARY_MAX_CHARS = int(os.getenv("CHAT_SUMMARY_MAX_CHARS", "1500"))
+#Load the Gemini SDK and build its clients in the background at startup instead of on the first AI request. 1 to enable.
+GEMINI_WARMUP = os.getenv("GEMINI_WARMUP", "0")
+#Shrink photos before the vision call: download the smallest Telegram size that is large enough, then downscale and re-encode. 1 to enable.
+IMAGE_PIPELINE_ENABLE = os.getenv("IMAGE_PIPELINE_ENABLE", "1")
+#Longest side in pixels of an image sent to the vision model, and its target size in bytes.
+#Telegram's photo sizes usually top out at 1280 (800 is too small for photographed text); recent clients also offer 2560, which this default avoids downloading.
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1280"))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(600 * 1024)))
+#JPEG quality to start from; it is lowered step by step while the image is above IMAGE_MAX_BYTES.
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+#Threads that decode and re-encode images.
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+#Downloaded photos kept in memory by file_unique_id (repeated and forwarded photos are not downloaded again): total size in MB and seconds kept.
+FILE_CACHE_MAX_MB = float(os.getenv("FILE_CACHE_MAX_MB", "32"))
+FILE_CACHE_TTL = int(os.getenv("FILE_CACHE_TTL", "3600"))
+#Files larger than this (MB) are not downloaded.
+FILE_MAX_DOWNLOAD_MB = float(os.getenv("FILE_MAX_DOWNLOAD_MB", "10"))
+#Keep-alive connections to api.telegram.org shared by all threads, and the connect/read timeouts in seconds of every Telegram call.
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "16"))
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
+TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "30"))
+#Outgoing messages are queued and sent by OUTBOX_WORKERS threads, at most TELEGRAM_CHAT_RATE per second to one chat (bursts of TELEGRAM_CHAT_BURST) and TELEGRAM_GLOBAL_RATE per second overall.
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+#Seconds a webhook request waits for the messages queued to its user before it returns.
+OUTBOX_FLUSH_TIMEOUT = float(os.getenv("OUTBOX_FLUSH_TIMEOUT", "20"))
+#How streamed answers reach the user. "edit": one message, updated in place as the answer arrives. "chunks": a new message every few seconds.
+STREAM_MODE = os.getenv("STREAM_MODE", "edit")
+#Seconds between two edits of a streamed message (Telegram allows about one message per second per chat).
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+#A streamed answer continues in a new message once the current one holds this many characters of MarkdownV2 (Telegram's limit is 4096).
+STREAM_MESSAGE_CHARS = int(os.getenv("STREAM_MESSAGE_CHARS", "4000"))
+#Answer the webhook at once and handle updates on WEBHOOK_WORKERS background threads. 1 to enable; needs a long-running server (not serverless functions, which may freeze after the response).
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+#Updates waiting for a worker; beyond this the webhook answers 503 and Telegram retries later.
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "100"))
+#Seconds allowed at shutdown to finish queued updates and send their replies.
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "25"))
+#Secret for the /metrics and /warmup endpoints, sent in the X-Ops-Secret header or as ?token=. Both answer 404 while it is empty.
+OPS_SECRET = os.getenv("OPS_SECRET", "")
+
 """ read https://ai.google.dev/api/rest/v1/GenerationConfig """
 generation_config = {
     "max_output_tokens": 8192,
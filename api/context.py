@@ -12,10 +12,9 @@ such as obtaining photos to addresses and so on.
 from io import BytesIO
 from typing import Dict
 
-import requests
-
-from .config import BOT_TOKEN
-from .gemini import ChatConversation, generate_text_with_image
+from .gemini import ChatConversation, cached_image_answer, generate_text_with_image
+from .image_pipeline import prepare_image_in_pool
+from .telegram_files import download_file, file_url
 
 
 class ChatManager:
@@ -36,26 +35,26 @@ class ChatManager:
 
 
 class ImageChatManger:
-    def __init__(self, prompt, file_id: str) -> None:
+    def __init__(self, prompt, file_id: str, file_unique_id: str = None) -> None:
         self.prompt = prompt
         self.file_id = file_id
+        self.file_unique_id = file_unique_id
 
     def tel_photo_url(self) -> str:
-        """process telegram photo url"""
-        r_file_id = requests.get(
-            f"https://api.telegram.org/bot{BOT_TOKEN}/getFile?file_id={self.file_id}"
-        )
-        file_path = r_file_id.json().get("result").get("file_path")
-        download_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-        return download_url
+        """process telegram photo url (getFile results are cached)"""
+        return file_url(self.file_id)
 
     def photo_bytes(self) -> BytesIO:
-        """get photo bytes"""
-        photo_url = self.tel_photo_url()
-        response = requests.get(photo_url)
-        photo_bytes = BytesIO(response.content)
-        return photo_bytes
+        """get photo bytes (cached by file_unique_id)"""
+        return download_file(self.file_id, self.file_unique_id)
 
     def send_image(self) -> str:
-        response = generate_text_with_image(self.prompt, self.photo_bytes())
+        cached_response = cached_image_answer(self.prompt, self.file_unique_id)
+        if cached_response is not None:
+            return cached_response
+        try:
+            photo_bytes = self.photo_bytes()
+        except Exception as e:
+            return f"Could not download the photo: {e}"
+        response = generate_text_with_image(self.prompt, prepare_image_in_pool(photo_bytes), self.file_unique_id)
         return response
@@ -0,0 +1,275 @@
+# api/dispatcher.py
+"""
+Outbound queue for Telegram messages.
+
+Handlers call queue_message() and go on; OUTBOX_WORKERS sender threads deliver
+the queue while staying under Telegram's flood limits: a token bucket per chat
+(TELEGRAM_CHAT_RATE messages per second, bursts of TELEGRAM_CHAT_BURST) and one
+for the whole bot (TELEGRAM_GLOBAL_RATE). A 429 answer puts the message back at
+the head of its chat's queue and pauses that chat for the `retry_after` seconds
+Telegram asks for; so does a failure to connect. Any other error (a read
+timeout, say) may come after Telegram accepted the message, so the message is
+dropped rather than risk sending it twice. A chat is served by one sender at a time, so its messages
+arrive in the order they were queued, and texts still waiting for the same
+chat are merged into one message while they fit in TELEGRAM_MAX_MESSAGE_CHARS.
+
+Streamed answers (see streaming.py) queue a placeholder with queue_placeholder()
+and then edits of it with queue_edit(), so their edits share the same limits;
+of several edits still waiting for one message only the newest is sent.
+
+tracking_chats() records the chats a handler queued to, so a serverless
+webhook can flush() exactly those before it returns.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import requests
+
+from .config import TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_GLOBAL_RATE, OUTBOX_WORKERS
+from .telegram import send_message, send_imageMessage, edit_message_text
+
+TELEGRAM_MAX_MESSAGE_CHARS = 4096
+MAX_SEND_ATTEMPTS = 5 # Per message, counting 429 answers and connection failures
+NETWORK_RETRY_DELAY = 1.0 # Seconds a chat waits after a failed connection
+MAX_IDLE_BUCKETS = 1000 # Chat buckets kept before refilled ones are dropped
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class OutboundDispatcher:
+    def __init__(self, workers=OUTBOX_WORKERS):
+        self.workers = workers
+        self._queues = {} # chat_id -> deque of pending messages (dicts)
+        self._chat_buckets = {} # chat_id -> TokenBucket
+        self._paused_until = {} # chat_id -> monotonic time before which the chat is not served (429 or error)
+        self._busy = set() # Chats a sender is delivering to right now
+        self._global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._cond = threading.Condition()
+        self._threads = []
+        self._local = threading.local() # .chats: set collecting the chat IDs queued to by this thread, see tracking_chats()
+        self.stats_counters = {"queued": 0, "sent": 0, "merged": 0, "skipped": 0, "rate_limited": 0, "errors": 0, "rejected": 0, "failed": 0}
+
+    def _start(self):
+        """Starts the sender threads on first use (called with the lock held)."""
+        if self._threads:
+            return
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"outbox-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, chat_id, kind, text, join="\n\n", handle=None, **kwargs):
+        message = {"kind": kind, "text": text, "join": join, "handle": handle, "kwargs": kwargs, "attempts": 0}
+        tracked_chats = getattr(self._local, "chats", None)
+        if tracked_chats is not None:
+            tracked_chats.add(chat_id)
+        with self._cond:
+            self._start()
+            self._queues.setdefault(chat_id, deque()).append(message)
+            self.stats_counters["queued"] += 1
+            if len(self._chat_buckets) > MAX_IDLE_BUCKETS:
+                self._prune_buckets()
+            self._cond.notify()
+
+    def _prune_buckets(self):
+        """Forgets the buckets of idle chats that have refilled, which behave like new ones (called with the lock held)."""
+        now = time.monotonic()
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if chat_id not in self._queues and bucket.wait_time(now) == 0 and bucket.tokens >= bucket.capacity \
+                    and self._paused_until.get(chat_id, 0) <= now:
+                del self._chat_buckets[chat_id]
+                self._paused_until.pop(chat_id, None)
+
+    def _next_chat(self):
+        """Returns (chat_id, None) for a chat that may be served now, or (None, seconds to wait) (called with the lock held)."""
+        now = time.monotonic()
+        wait = None
+        global_wait = self._global_bucket.wait_time(now)
+        for chat_id, queue in self._queues.items():
+            if not queue or chat_id in self._busy:
+                continue
+            bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST))
+            chat_wait = max(bucket.wait_time(now), self._paused_until.get(chat_id, 0) - now, global_wait)
+            if chat_wait <= 0:
+                return chat_id, None
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, wait
+
+    def _take_batch(self, chat_id):
+        """
+        Pops the next message of a chat, merged with the texts queued behind it while they fit, or for an edit
+        the newest edit of the same message waiting right behind it (called with the lock held).
+        """
+        queue = self._queues[chat_id]
+        message = queue.popleft()
+        if message["kind"] == "edit":
+            while queue and queue[0]["kind"] == "edit" and queue[0]["handle"] is message["handle"]:
+                message = queue.popleft()
+                self.stats_counters["merged"] += 1
+            return message
+        if message["kind"] != "text" or message["handle"]:
+            return message # Placeholders are edited later, so nothing may be merged into them
+        while queue and queue[0]["kind"] == "text" and not queue[0]["handle"] and queue[0]["kwargs"] == message["kwargs"] \
+                and len(message["text"]) + len(queue[0]["join"]) + len(queue[0]["text"]) <= TELEGRAM_MAX_MESSAGE_CHARS:
+            following = queue.popleft()
+            message = {**message, "text": message["text"] + following["join"] + following["text"]}
+            self.stats_counters["merged"] += 1
+        return message
+
+    def _run(self):
+        while True:
+            with self._cond:
+                chat_id, wait = self._next_chat()
+                while chat_id is None:
+                    self._cond.wait(timeout=wait)
+                    chat_id, wait = self._next_chat()
+                now = time.monotonic()
+                self._global_bucket.take(now)
+                self._chat_buckets[chat_id].take(now)
+                self._busy.add(chat_id)
+                message = self._take_batch(chat_id)
+
+            outcome, retry_after = self._deliver(chat_id, message)
+
+            with self._cond:
+                self._busy.discard(chat_id)
+                self.stats_counters[outcome] += 1
+                if outcome == "errors" and retry_after is None:
+                    self.stats_counters["failed"] += 1
+                elif retry_after is not None:
+                    message["attempts"] += 1
+                    if message["attempts"] < MAX_SEND_ATTEMPTS:
+                        self._queues[chat_id].appendleft(message) # Keep its place in the chat's order
+                        self._paused_until[chat_id] = time.monotonic() + retry_after
+                    else:
+                        self.stats_counters["failed"] += 1
+                        print(f"Dropping message to {chat_id} after {message['attempts']} attempts.")
+                if not self._queues[chat_id]:
+                    del self._queues[chat_id] # Its bucket stays, so the next message still respects the chat's rate
+                self._cond.notify_all()
+
+    def _send(self, chat_id, message):
+        """Makes the Telegram call(s) for one message; returns the response, or None if there was nothing to send."""
+        kwargs = message["kwargs"]
+        if message["kind"] == "photo":
+            return send_imageMessage(chat_id, message["text"], kwargs["photo"])
+        if message["kind"] != "edit":
+            return send_message(chat_id, message["text"], **kwargs)
+
+        handle = message["handle"]
+        if handle["message_id"] is None: # The placeholder could not be sent: the final text becomes a message of its own
+            return send_message(chat_id, message["text"], formatted=True) if kwargs["final"] else None
+        if message["text"] == handle["text"]:
+            return None
+        response = edit_message_text(chat_id, handle["message_id"], message["text"], formatted=True)
+        if response.status_code == 400 and "not modified" not in response.text:
+            print(f"Telegram could not parse a streamed message for {chat_id}: {response.text[:200]}")
+            response = edit_message_text(chat_id, handle["message_id"], kwargs["source"], parse_mode=None)
+        return response
+
+    def _deliver(self, chat_id, message):
+        """Sends one message; returns (outcome counter, None) when done, or (outcome counter, seconds to wait before retrying it)."""
+        try:
+            response = self._send(chat_id, message)
+        except (requests.ConnectionError, requests.ConnectTimeout) as e: # Nothing reached Telegram
+            print(f"Error connecting to send to {chat_id}: {e}")
+            return "errors", NETWORK_RETRY_DELAY
+        except Exception as e: # Telegram may have delivered it already
+            print(f"Error sending to {chat_id}, not retried: {e}")
+            return "errors", None
+        if response is None:
+            return "skipped", None
+        if response.status_code == 429:
+            try:
+                retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+            except Exception: # Not the JSON Telegram normally answers with
+                retry_after = 1
+            print(f"Telegram rate limit for {chat_id}, retrying in {retry_after}s.")
+            return "rate_limited", retry_after
+        if not response.ok and "not modified" not in response.text:
+            print(f"Telegram rejected a message to {chat_id}: {response.status_code} {response.text[:200]}")
+            return "rejected", None
+        if message["handle"] is not None:
+            if message["kind"] == "edit":
+                message["handle"]["text"] = message["text"]
+            elif response.ok:
+                try:
+                    message["handle"]["message_id"] = response.json()["result"]["message_id"]
+                except Exception as e: # Left None: the final edit is sent as a new message instead
+                    print(f"No message_id in Telegram's answer for {chat_id}: {e}")
+        return "sent", None
+
+    @contextmanager
+    def tracking_chats(self):
+        """Yields a set that collects the chat IDs messages are queued to from this thread inside the with block."""
+        self._local.chats = chat_ids = set()
+        try:
+            yield chat_ids
+        finally:
+            self._local.chats = None
+
+    def flush(self, timeout=None, chat_ids=None):
+        """Waits until every queued message (of chat_ids only, if given) was delivered or dropped; returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while any(chat_id in self._queues for chat_id in chat_ids) if chat_ids is not None else self._queues:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(timeout=remaining)
+        return True
+
+    def stats(self):
+        with self._cond:
+            return {**self.stats_counters, "pending": sum(len(queue) for queue in self._queues.values()),
+                    "chats": len(self._queues)}
+
+
+DISPATCHER = OutboundDispatcher()
+
+
+def queue_message(chat_id, text, join="\n\n", **kwargs):
+    """Queues a text message (send_message arguments); `join` separates it from a pending text it is merged into."""
+    DISPATCHER.put(chat_id, "text", text, join, **kwargs)
+
+
+def queue_photo(chat_id, caption, image_id):
+    DISPATCHER.put(chat_id, "photo", caption, photo=image_id)
+
+
+def queue_placeholder(chat_id, text):
+    """Queues a message for queue_edit() to replace; returns its handle, whose "message_id" is set once it was sent."""
+    handle = {"message_id": None, "text": None} # "text": what the message shows after the last delivered edit
+    DISPATCHER.put(chat_id, "text", text, handle=handle)
+    return handle
+
+
+def queue_edit(chat_id, handle, text, source_text, final=False):
+    """
+    Queues an edit showing text (MarkdownV2) in the placeholder of handle; if Telegram cannot parse it,
+    source_text is shown as plain text. A final edit is sent as a new message if the placeholder failed.
+    """
+    DISPATCHER.put(chat_id, "edit", text, handle=handle, source=source_text, final=final)
@@ -1,18 +1,29 @@
 # api/gemini.py
+"""
+Gemini text, vision and chat calls.
+
+The Gemini SDK (with grpc) and PIL are imported on first use rather than at
+import time, so cold starts that only serve /health or the status page do not
+pay for them; call warm_up() to load them ahead of the first request.
+"""
 from io import BytesIO
 import os # For GOOGLE_API_KEY check if needed, though config.py handles it primarily
-
-import google.generativeai as genai
-import PIL.Image
-
-from .config import GOOGLE_API_KEY, generation_config, safety_settings
+import threading
+import time
+
+from .answer_cache import answer_key, get_answer, put_answer
+from .config import GOOGLE_API_KEY, ANSWER_CACHE_ENABLE, GEMINI_TIMEOUT, GEMINI_STREAM_TIMEOUT, GEMINI_RETRIES, \
+    GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_RESET, CHAT_HISTORY_TURNS, CHAT_SUMMARY_MAX_CHARS, generation_config, safety_settings
+from .key_pool import KeyPool, PooledKey
+from .resilience import CircuitBreaker, CircuitOpenError, retry_call
 from .printLog import send_log # For logging critical errors
 
-# Ensure GOOGLE_API_KEY is not empty and select the first key
+# Ensure GOOGLE_API_KEY is not empty; every configured key gets its own client in KEY_POOL
 # config.py already splits it, so GOOGLE_API_KEY should be a list
 CONFIGURED_API_KEY = None
-if GOOGLE_API_KEY and isinstance(GOOGLE_API_KEY, list) and len(GOOGLE_API_KEY) > 0 and GOOGLE_API_KEY[0]:
-    CONFIGURED_API_KEY = GOOGLE_API_KEY[0]
+CONFIGURED_API_KEYS = [key for key in GOOGLE_API_KEY if key] if isinstance(GOOGLE_API_KEY, list) else []
+if CONFIGURED_API_KEYS:
+    CONFIGURED_API_KEY = CONFIGURED_API_KEYS[0]
 else:
     # Log this critical issue, as the bot won't function
     log_message = "CRITICAL WARNING: GOOGLE_API_KEY is not configured properly or is empty in config.py. Gemini models cannot be initialized."
@@ -23,24 +34,68 @@ else:
 # Use model names as originally specified by the user
 MODEL_NAME_DEFAULT = "gemma-4-31b-it" # User's original model
 # MODEL_NAME_DEFAULT = "gemini-1.5-flash-latest" # Alternative modern option
+CACHE_REPLAY_CHUNK_CHARS = 500 # Cached answers are yielded in pieces like a live stream
 
-model_usual = None
+model_usual = None # Models of the first key; None until _ensure_models() succeeded
 model_vision = None
+KEY_POOL = KeyPool([]) # Filled with one PooledKey per API key by _ensure_models()
+MODELS_LOCK = threading.Lock()
+MODELS_STATE = {"initialized": False} # Set once model initialization was attempted
+GEMINI_BREAKER = CircuitBreaker("Gemini", GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_RESET)
 
-if CONFIGURED_API_KEY:
-    try:
-        genai.configure(api_key=CONFIGURED_API_KEY)
-        
-        model_usual = genai.GenerativeModel(
-            model_name=MODEL_NAME_DEFAULT, 
-            generation_config=generation_config,
-            safety_settings=safety_settings)
 
-        model_vision = genai.GenerativeModel( # Assuming vision also uses the same base model or a vision-capable variant
+CALL_DEADLINE = threading.local() # .at: time.monotonic() by which the current thread's Gemini call must be done
+
+
+def _time_left(default):
+    deadline = getattr(CALL_DEADLINE, "at", None)
+    return default if deadline is None else max(0.1, deadline - time.monotonic())
+
+
+class _DeadlineClient:
+    """
+    Passes the time left before the call's deadline to every request of a GenerativeServiceClient.
+    (google-generativeai 0.3 has no per-request options, but its models only call these two methods.)
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content(self, request):
+        return self._client.generate_content(request, timeout=_time_left(GEMINI_TIMEOUT))
+
+    def stream_generate_content(self, request):
+        return self._client.stream_generate_content(request, timeout=_time_left(GEMINI_STREAM_TIMEOUT))
+
+
+def _build_models(api_key):
+    """Creates the usual and vision models bound to their own client for one API key."""
+    import google.ai.generativelanguage as glm
+    import google.generativeai as genai
+
+    key_client = _DeadlineClient(glm.GenerativeServiceClient(client_options={"api_key": api_key}))
+    models = {}
+    for kind in ("usual", "vision"): # Vision uses the same base model or a vision-capable variant
+        model = genai.GenerativeModel(
             model_name=MODEL_NAME_DEFAULT, # Or "gemini-pro-vision" if that's intended and available
             generation_config=generation_config,
             safety_settings=safety_settings)
-        print(f"Gemini models ('{MODEL_NAME_DEFAULT}') initialized successfully.")
+        model._client = key_client # Instead of the process-wide client of genai.configure()
+        models[kind] = model
+    return models
+
+
+def _init_models():
+    global model_usual, model_vision
+    if not CONFIGURED_API_KEY:
+        return # This case is already logged above. Models remain None.
+    try:
+        import google.generativeai as genai
+        genai.configure(api_key=CONFIGURED_API_KEY) # Still used by genai.list_models()
+        KEY_POOL.keys = [PooledKey(api_key, _build_models(api_key)) for api_key in CONFIGURED_API_KEYS]
+        model_usual = KEY_POOL.keys[0].models["usual"]
+        model_vision = KEY_POOL.keys[0].models["vision"]
+        print(f"Gemini models ('{MODEL_NAME_DEFAULT}') initialized successfully for {len(KEY_POOL.keys)} API key(s).")
         #send_log(f"Gemini models ('{MODEL_NAME_DEFAULT}') initialized successfully.")
 
     except Exception as e:
@@ -48,9 +103,81 @@ if CONFIGURED_API_KEY:
         print(error_log_msg)
         send_log(error_log_msg)
         # Models will remain None
-else:
-    # This case is already logged above. Models remain None.
-    pass
+
+
+def _ensure_models():
+    """Initializes the Gemini models on first use (once, even with concurrent callers); returns True if they are available."""
+    if not MODELS_STATE["initialized"]:
+        with MODELS_LOCK:
+            if not MODELS_STATE["initialized"]:
+                _init_models()
+                MODELS_STATE["initialized"] = True
+    return model_usual is not None
+
+
+def warm_up():
+    """Loads the Gemini SDK and PIL and builds the models now instead of on the first request."""
+    import PIL.Image # noqa: F401 (only imported to warm the module cache)
+    return _ensure_models()
+
+
+def _is_quota_error(error):
+    return getattr(error, "code", None) == 429 # ResourceExhausted / TooManyRequests
+
+
+def _call_with_pool(kind, call, timeout=GEMINI_TIMEOUT):
+    """
+    Runs call(model) with the `kind` model of the least busy API key and returns (result, release).
+
+    Every Gemini request goes through here. A 429/quota error puts the key on
+    cooldown and retries on the next key; streams raise it before the first
+    chunk, so a burst fails over before anything reached the user. Timeouts and
+    500/503 errors are retried with backoff, and while GEMINI_BREAKER is open
+    calls fail at once with CircuitOpenError. All of that happens within one
+    deadline `timeout` seconds away (GEMINI_STREAM_TIMEOUT for streams, which
+    covers the whole stream): every attempt only gets the time left, and no
+    retry or failover starts once it has passed. release() must be called once
+    the result (for streams, the whole stream) is consumed.
+    """
+    deadline = time.monotonic() + timeout
+    CALL_DEADLINE.at = deadline
+    try:
+        return GEMINI_BREAKER.call(lambda: retry_call(lambda: _call_with_failover(kind, call, deadline), retries=GEMINI_RETRIES,
+                                                      deadline=deadline))
+    finally:
+        CALL_DEADLINE.at = None
+
+
+def _call_with_failover(kind, call, deadline):
+    tried = []
+    last_error = None
+    while True:
+        key = KEY_POOL.acquire(exclude=tried) if time.monotonic() < deadline else None
+        if key is None:
+            raise last_error or RuntimeError("Every Gemini API key is cooling down after quota errors. Please try again shortly.")
+        try:
+            result = call(key.models[kind])
+        except Exception as e:
+            if not _is_quota_error(e):
+                KEY_POOL.release(key)
+                raise
+            KEY_POOL.release(key, quota_error=True)
+            print(f"Gemini API key {key.label} hit its quota, trying another key: {e}")
+            tried.append(key)
+            last_error = e
+            continue
+        return result, lambda: KEY_POOL.release(key)
+
+
+def _error_text(error):
+    """What users are told about a failed Gemini call."""
+    if isinstance(error, CircuitOpenError):
+        return str(error)
+    if getattr(error, "code", None) == 504: # DeadlineExceeded
+        return "The AI took too long to answer. Please try again."
+    if _is_quota_error(error):
+        return "The AI is receiving too many requests right now. Please try again in a minute."
+    return repr(error)
 
 
 def _parse_gemini_response(response, context_for_error=""):
@@ -99,48 +226,107 @@ def _parse_gemini_response(response, context_for_error=""):
         return f"An unexpected error occurred while processing the response from the AI. Details: {e}"
 
 
-def generate_content(prompt: str) -> str:
-    """Generate text from prompt (non-streaming)."""
-    if not model_usual:
+def _is_complete_response(response):
+    """True if a response was neither blocked nor stopped for a reason other than finishing."""
+    if response.prompt_feedback and response.prompt_feedback.block_reason:
+        return False
+    return bool(response.candidates) and not (response.candidates[0].finish_reason and str(response.candidates[0].finish_reason).upper()
+                                              not in ["STOP", "UNSPECIFIED", "MAX_TOKENS", "NULL"])
+
+
+def generate_content(prompt: str, use_cache: bool = False, raise_errors: bool = False) -> str:
+    """
+    Generate text from prompt (non-streaming). With use_cache, identical prompts are answered from the answer cache.
+    With raise_errors, a failed, blocked or cut short answer raises instead of being returned as an error message.
+    """
+    cache_key = answer_key(MODEL_NAME_DEFAULT, prompt) if use_cache and ANSWER_CACHE_ENABLE == "1" else None
+    if cache_key:
+        cached_answer = get_answer(cache_key)
+        if cached_answer is not None:
+            return cached_answer
+
+    if not _ensure_models():
         no_model_msg = "Error: Text generation model is not available. Please check configuration and logs."
         send_log(no_model_msg + f" (Prompt: {prompt[:100]}...)")
+        if raise_errors:
+            raise RuntimeError(no_model_msg)
         return no_model_msg
     try:
-        response = model_usual.generate_content(prompt)
-        return _parse_gemini_response(response, context_for_error=f"for non-streaming prompt: {prompt[:100]}...")
+        response, release = _call_with_pool("usual", lambda model: model.generate_content(prompt))
+        release()
+        answer = _parse_gemini_response(response, context_for_error=f"for non-streaming prompt: {prompt[:100]}...")
+        complete = _is_complete_response(response) and answer.strip()
+        if cache_key and complete:
+            put_answer(cache_key, MODEL_NAME_DEFAULT, answer)
     except Exception as e:
-        error_msg = f"Something went wrong generating content!\n{repr(e)}"
+        error_msg = f"Something went wrong generating content!\n{_error_text(e)}"
         send_log(f"Gemini generate_content EXCEPTION for prompt '{prompt[:100]}...': {error_msg}")
+        if raise_errors:
+            raise
         return error_msg
+    if raise_errors and not complete:
+        raise RuntimeError(f"Incomplete answer: {answer[:100]}")
+    return answer
+
 
+def _image_answer_key(prompt, image_id):
+    return answer_key(MODEL_NAME_DEFAULT, f"image:{image_id}\0{prompt}") if image_id and ANSWER_CACHE_ENABLE == "1" else None
 
-def generate_text_with_image(prompt: str, image_bytes: BytesIO) -> str:
-    """Generate text from prompt and image (non-streaming)."""
-    if not model_vision:
+
+def cached_image_answer(prompt: str, image_id: str):
+    """Returns the answer cached for this image (a Telegram file_unique_id) and prompt, or None."""
+    cache_key = _image_answer_key(prompt, image_id)
+    return get_answer(cache_key) if cache_key else None
+
+
+def generate_text_with_image(prompt: str, image_bytes: BytesIO, image_id: str = None) -> str:
+    """Generate text from prompt and image (non-streaming). With image_id, a complete answer is stored for cached_image_answer()."""
+    if not _ensure_models():
         no_model_msg = "Error: Vision model is not available. Please check configuration and logs."
         send_log(no_model_msg + f" (Prompt: {prompt[:100]}...)")
         return no_model_msg
     try:
+        import PIL.Image
         img = PIL.Image.open(image_bytes)
         # For multimodal, content should be a list: [text_prompt, image_object]
-        response = model_vision.generate_content([prompt, img]) 
-        return _parse_gemini_response(response, context_for_error=f"for image prompt: {prompt[:100]}...")
+        response, release = _call_with_pool("vision", lambda model: model.generate_content([prompt, img]))
+        release()
+        answer = _parse_gemini_response(response, context_for_error=f"for image prompt: {prompt[:100]}...")
+        cache_key = _image_answer_key(prompt, image_id)
+        if cache_key and _is_complete_response(response) and answer.strip():
+            put_answer(cache_key, MODEL_NAME_DEFAULT, answer)
+        return answer
     except Exception as e:
-        error_msg = f"Something went wrong generating text with image!\n{repr(e)}"
+        error_msg = f"Something went wrong generating text with image!\n{_error_text(e)}"
         send_log(f"Gemini generate_text_with_image EXCEPTION for prompt '{prompt[:100]}...': {error_msg}")
         return error_msg
 
 
-def generate_content_stream(prompt: str):
-    """Generates content in streaming mode, yielding chunks of the response."""
-    if not model_usual:
+def generate_content_stream(prompt: str, use_cache: bool = False):
+    """
+    Generates content in streaming mode, yielding chunks of the response.
+    With use_cache, an answer cached for the same prompt is replayed instead, and a
+    stream that completes normally is stored for next time.
+    """
+    cache_key = answer_key(MODEL_NAME_DEFAULT, prompt) if use_cache and ANSWER_CACHE_ENABLE == "1" else None
+    if cache_key:
+        cached_answer = get_answer(cache_key)
+        if cached_answer is not None:
+            for start in range(0, len(cached_answer), CACHE_REPLAY_CHUNK_CHARS):
+                yield cached_answer[start:start + CACHE_REPLAY_CHUNK_CHARS]
+            return
+
+    if not _ensure_models():
         no_model_msg = "Error: Text generation model for streaming is not available. Check logs."
         send_log(no_model_msg + f" (Prompt: {prompt[:100]}...)")
         yield no_model_msg
         return
     
+    answer_parts = []
+    answer_complete = True # Only answers that were neither blocked nor cut short are cached
+    release = None
     try:
-        response_stream = model_usual.generate_content(prompt, stream=True)
+        response_stream, release = _call_with_pool("usual", lambda model: model.generate_content(prompt, stream=True), GEMINI_STREAM_TIMEOUT)
         for chunk in response_stream:
             # Parsing logic adapted from _parse_gemini_response for chunks
             chunk_text = ""
@@ -153,6 +339,7 @@ def generate_content_stream(prompt: str):
                 send_log(f"Gemini Stream Safety Block for prompt '{prompt[:100]}...': {block_reason_msg}")
                 yield f"\n\n[I'm sorry, further generation for this request was stopped due to content safety guidelines: {chunk.prompt_feedback.block_reason}]"
                 blocked_by_safety = True
+                answer_complete = False
                 break # Stop streaming if definitively blocked
 
             if chunk.candidates:
@@ -165,6 +352,7 @@ def generate_content_stream(prompt: str):
                 if candidate.finish_reason and str(candidate.finish_reason).upper() not in ["STOP", "UNSPECIFIED", "MAX_TOKENS", "NULL"]:
                     finish_reason_msg = f"Stream interrupted/altered. Reason: {candidate.finish_reason}."
                     send_log(f"Gemini Stream Finish Reason for prompt '{prompt[:100]}...': {finish_reason_msg}")
+                    answer_complete = False
                     if not chunk_text: # If no text in this chunk but a concerning finish reason
                         yield f"\n\n[Stream may have been affected: {candidate.finish_reason}]"
                     if str(candidate.finish_reason).upper() == "SAFETY": # Explicit safety stop
@@ -176,24 +364,45 @@ def generate_content_stream(prompt: str):
                  chunk_text = "".join(part.text for part in chunk.parts if hasattr(part, 'text'))
 
             if chunk_text:
+                answer_parts.append(chunk_text)
                 yield chunk_text
             
             if blocked_by_safety:
                 break # Exit outer loop if safety block occurred
 
     except Exception as e:
-        error_message = f"Streaming error!\n{repr(e)}"
+        error_message = f"Streaming error!\n{_error_text(e)}"
         send_log(f"Gemini generate_content_stream EXCEPTION for prompt '{prompt[:100]}...': {error_message}")
         yield error_message
+        return
+    finally:
+        if release:
+            release()
+
+    if cache_key and answer_complete and "".join(answer_parts).strip():
+        put_answer(cache_key, MODEL_NAME_DEFAULT, "".join(answer_parts))
 
 
 class ChatConversation:
-    """Manages an ongoing chat conversation, with streaming responses."""
+    """
+    Manages an ongoing chat conversation, with streaming responses.
+
+    Only the last CHAT_HISTORY_TURNS turns are resent verbatim. Once twice that many
+    have piled up, the older half is folded into a running summary (at most
+    CHAT_SUMMARY_MAX_CHARS) that opens the history, so each message costs about
+    the same however long the chat gets. The fold runs on a background thread
+    after the answer was streamed, so it never delays a reply; the next message
+    waits for it only if it arrives while the summary is still being written.
+    """
     def __init__(self) -> None:
         self.chat = None
         self.user_prompt_history = [] # For tracking user turns for /new logic
+        self.summary = "" # Running summary of the turns folded out of the history
+        self.summarized_turns = 0
+        self.fold_thread = None # Background _fold_history() started after the last answer
+        self.fold_started = False # Whether the last answer started folding old turns; set before the fold thread runs
 
-        if not model_usual:
+        if not _ensure_models():
             log_msg = "Warning: ChatConversation initialized, but 'model_usual' is None. Chat will not function."
             print(log_msg)
             send_log(log_msg)
@@ -214,6 +423,10 @@ class ChatConversation:
             yield no_chat_msg
             return
 
+        if self.fold_thread:
+            self.fold_thread.join() # The history is being replaced; send on top of the new one
+            self.fold_thread = None
+
         current_prompt_lower = prompt.lower().strip()
         if current_prompt_lower != "/new":
              self.user_prompt_history.append(prompt)
@@ -223,6 +436,8 @@ class ChatConversation:
                 try:
                     self.chat = model_usual.start_chat(history=[]) 
                     self.user_prompt_history = [] 
+                    self.summary = ""
+                    self.summarized_turns = 0
                     yield "We're having a fresh chat now." 
                 except Exception as e:
                     err_msg = f"Error resetting chat with /new: {e}"
@@ -232,9 +447,13 @@ class ChatConversation:
                 yield "Error: Cannot start a new chat as the underlying model is unavailable."
             return 
 
+        release = None
         try:
             # Use the same streaming logic as generate_content_stream
-            response_stream = self.chat.send_message(prompt, stream=True)
+            def send(model):
+                self.chat.model = model # The history stays in the session; each turn may use another key
+                return self.chat.send_message(prompt, stream=True)
+            response_stream, release = _call_with_pool("usual", send, GEMINI_STREAM_TIMEOUT)
             for chunk in response_stream:
                 chunk_text = ""
                 blocked_by_safety = False
@@ -275,13 +494,61 @@ class ChatConversation:
                     # self.user_prompt_history = []
                     break
         except Exception as e:
-            error_message = f"Chat streaming error!\n{repr(e)}"
+            error_message = f"Chat streaming error!\n{_error_text(e)}"
             send_log(f"Gemini ChatConversation.send_message EXCEPTION for prompt '{prompt[:100]}...': {error_message}")
             yield error_message
             # Optionally reset chat on severe errors to prevent broken state
             # if model_usual: self.chat = model_usual.start_chat(history=[])
             # self.user_prompt_history = []
             # yield "Chat history has been reset due to an error."
+        finally:
+            if release:
+                release()
+        self.fold_started = self._needs_fold()
+        if self.fold_started:
+            self.fold_thread = threading.Thread(target=self._fold_history, name="chat-summary", daemon=True)
+            self.fold_thread.start()
+
+    def _summary_turn(self):
+        """The exchange that carries the running summary at the start of the history."""
+        return [{"role": "user", "parts": [f"Summary of our conversation so far:\n{self.summary}"]},
+                {"role": "model", "parts": ["Understood, I will keep that in mind."]}]
+
+    def _turns(self):
+        """The history after the summary exchange as [message, reply] pairs, or None if it cannot be read."""
+        try:
+            history = list(self.chat.history)
+        except Exception as e: # A broken stream leaves no coherent history to fold
+            print(f"Chat history not folded: {e}")
+            return None
+        offset = 2 if self.summary else 0 # Skip the summary exchange itself
+        return [history[i:i + 2] for i in range(offset, len(history), 2)]
+
+    def _needs_fold(self):
+        if CHAT_HISTORY_TURNS <= 0 or not self.chat:
+            return False
+        turns = self._turns()
+        return turns is not None and len(turns) > 2 * CHAT_HISTORY_TURNS
+
+    def _fold_history(self):
+        """Folds the oldest turns into the summary once more than 2 * CHAT_HISTORY_TURNS turns are kept."""
+        if not self._needs_fold():
+            return
+        turns = self._turns()
+
+        folded, kept = turns[:-CHAT_HISTORY_TURNS], turns[-CHAT_HISTORY_TURNS:]
+        transcript = "\n".join(f"{content.role}: {''.join(part.text for part in content.parts)}" for turn in folded for content in turn)
+        try:
+            summary = generate_content(
+                f"Update this summary of a conversation between a student (user) and an AI tutor (model) with the new turns below. "
+                f"Keep names, facts, decisions and open questions; stay under {CHAT_SUMMARY_MAX_CHARS} characters and reply with the summary only.\n\n"
+                f"Summary so far:\n{self.summary or '(none)'}\n\nNew turns:\n{transcript}", raise_errors=True)
+            self.summary = summary[:CHAT_SUMMARY_MAX_CHARS]
+        except Exception as e: # Could not summarize: drop the old turns rather than grow
+            print(f"Chat summary failed, dropping {len(folded)} turns: {e}")
+        self.summarized_turns += len(folded)
+        kept_history = [content for turn in kept for content in turn]
+        self.chat = self.chat.model.start_chat(history=(self._summary_turn() if self.summary else []) + kept_history)
 
     @property
     def history(self):
@@ -289,14 +556,16 @@ class ChatConversation:
 
     @property
     def history_length(self):
-        # Gemini's chat.history includes both user and model turns.
+        # Gemini's chat.history includes both user and model turns (and the summary exchange, once there is one),
+        # i.e. what is resent with every message. Turns folded into the summary are counted in summarized_turns.
         # Number of user messages can be len(self.user_prompt_history)
         return len(self.chat.history) if self.chat else 0
 
 
 if __name__ == "__main__":
     print("--- Gemini Module (__main__) ---")
-    if CONFIGURED_API_KEY and model_usual: # Check if models were actually initialized
+    if CONFIGURED_API_KEY and _ensure_models(): # Check if models were actually initialized
+        import google.generativeai as genai
         print("\n--- Listing Models ---")
         # list_models() # This is a function in command.py, not here directly.
         # For local testing of this module, can call genai's list_models
@@ -0,0 +1,35 @@
+# api/http_session.py
+"""
+One shared HTTP session for every Telegram Bot API call.
+
+requests.post() opens a new TCP and TLS connection to api.telegram.org on
+every call; the session keeps up to TELEGRAM_POOL_SIZE connections alive and
+reuses them across requests and threads. Connection failures (nothing was
+sent yet) are retried; anything later is not, as a POST may have been
+delivered. Every call gets TELEGRAM_TIMEOUT so a stuck connection cannot hold
+a request thread forever.
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .config import TELEGRAM_POOL_SIZE, TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT
+
+TELEGRAM_TIMEOUT = (TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT)
+CONNECT_RETRIES = 2
+
+
+def _build_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=2, # Hosts: api.telegram.org for both methods and file downloads
+        pool_maxsize=TELEGRAM_POOL_SIZE, # Connections kept alive per host
+        pool_block=False, # Beyond the pool, open an extra connection rather than wait
+        max_retries=Retry(total=CONNECT_RETRIES, connect=CONNECT_RETRIES, read=0, redirect=0, status=0, backoff_factor=0.2),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+TELEGRAM_SESSION = _build_session() # Used from every request and worker thread; the adapter's pool is thread-safe
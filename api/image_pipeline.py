@@ -0,0 +1,73 @@
+# api/image_pipeline.py
+"""
+Shrinks photos before they are sent to the vision model.
+
+Telegram offers each photo in several sizes; select_photo_size() picks the
+smallest one whose longer side still reaches IMAGE_MAX_SIDE, so phone photos
+are not downloaded at full resolution. prepare_image() then rotates the image
+upright, scales it down to IMAGE_MAX_SIDE and re-encodes it as a JPEG without
+metadata (EXIF, GPS, ICC), lowering the quality until it fits IMAGE_MAX_BYTES.
+The work runs on a small thread pool so that Pillow decodes do not pile up
+on the request threads.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from .config import IMAGE_PIPELINE_ENABLE, IMAGE_MAX_SIDE, IMAGE_MAX_BYTES, IMAGE_JPEG_QUALITY, IMAGE_WORKERS
+
+MIN_JPEG_QUALITY = 40
+QUALITY_STEP = 10
+IMAGE_TIMEOUT = 30 # Seconds to wait for the pool before giving up on an image
+IMAGE_EXECUTOR = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+
+def select_photo_size(photo_sizes, min_side=IMAGE_MAX_SIDE):
+    """Returns the smallest PhotoSize of a Telegram `photo` array whose longer side is at least min_side (else the largest)."""
+    if IMAGE_PIPELINE_ENABLE != "1":
+        return photo_sizes[-1]
+    ordered = sorted(photo_sizes, key=lambda size: size["width"] * size["height"])
+    for size in ordered:
+        if max(size["width"], size["height"]) >= min_side:
+            return size
+    return ordered[-1]
+
+
+def _encode_jpeg(image, quality):
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=quality, optimize=True) # No exif= / icc_profile= argument, so no metadata is written
+    return output
+
+
+def prepare_image(image_bytes: BytesIO) -> BytesIO:
+    """Returns the photo upright, at most IMAGE_MAX_SIDE pixels on its longer side, as a metadata-free JPEG within IMAGE_MAX_BYTES if possible."""
+    if IMAGE_PIPELINE_ENABLE != "1":
+        return image_bytes
+    import PIL.Image
+    import PIL.ImageOps
+
+    original_size = image_bytes.getbuffer().nbytes
+    image = PIL.Image.open(image_bytes)
+    image = PIL.ImageOps.exif_transpose(image) # Apply the camera's rotation before the EXIF block is dropped
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), PIL.Image.LANCZOS)
+
+    quality = IMAGE_JPEG_QUALITY
+    output = _encode_jpeg(image, quality)
+    while output.getbuffer().nbytes > IMAGE_MAX_BYTES and quality - QUALITY_STEP >= MIN_JPEG_QUALITY:
+        quality -= QUALITY_STEP
+        output = _encode_jpeg(image, quality)
+    print(f"Prepared image: {original_size // 1024} KB -> {output.getbuffer().nbytes // 1024} KB, {image.size[0]}x{image.size[1]}, quality {quality}")
+    output.seek(0)
+    return output
+
+
+def prepare_image_in_pool(image_bytes: BytesIO) -> BytesIO:
+    """Runs prepare_image on the image pool; falls back to the untouched bytes if it fails."""
+    try:
+        # The worker gets its own copy: after a timeout it may still be reading while the original is sent
+        return IMAGE_EXECUTOR.submit(prepare_image, BytesIO(image_bytes.getvalue())).result(timeout=IMAGE_TIMEOUT)
+    except Exception as e:
+        print(f"Image preprocessing failed, sending the original: {e}")
+        image_bytes.seek(0)
+        return image_bytes
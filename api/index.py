@@ -75,7 +75,13 @@ def health_check():
 from flask import Flask, render_template, request
 from .handle import handle_message
 import logging
-from .textbook_processor import get_textbook_content # Import get_textbook_content - Corrected import
+import hmac
+import threading
+from .textbook_processor import get_textbook_content, preload_textbooks # Import get_textbook_content - Corrected import
+from .gemini import warm_up
+from .config import GEMINI_WARMUP, OPS_SECRET, OUTBOX_FLUSH_TIMEOUT, WEBHOOK_ASYNC
+from .dispatcher import DISPATCHER
+from .update_queue import start_update_queue, is_duplicate_update, forget_update
 
 app = Flask(__name__)
 
@@ -84,6 +90,10 @@ logging.basicConfig(level=logging.INFO)
 
 # [!HIGHLIGHT!] Textbook loading section REMOVED from app initialization
 # Textbook loading is now lazy-loaded on demand
+preload_textbooks() # Warms the textbooks listed in TEXTBOOK_PRELOAD, if any, without blocking startup
+if GEMINI_WARMUP == "1":
+    threading.Thread(target=warm_up, name="gemini-warmup", daemon=True).start() # The SDK is otherwise loaded by the first AI request
+update_queue = start_update_queue(handle_message) if WEBHOOK_ASYNC == "1" else None # Updates answered from worker threads
 
 @app.route("/", methods=["POST", "GET"])
 def home():
@@ -94,7 +104,27 @@ def home():
             if not update or "update_id" not in update:
                 logging.warning("Invalid or incomplete update: %s", update)
                 return "Invalid request data", 400
-            handle_message(update)
+            if is_duplicate_update(update): # Telegram redelivers updates it thinks failed; answer them once
+                logging.info("Ignoring duplicate update %s", update["update_id"])
+                return "ok", 200
+            if update_queue:
+                if "from" not in update.get("message", {}):
+                    return "ok", 200 # Nothing the bot answers (edits, channel posts, ...)
+                if not update_queue.submit(update):
+                    forget_update(update)
+                    logging.warning("Update queue full, asking Telegram to retry update %s", update["update_id"])
+                    return "Busy", 503
+                return "ok", 200
+            try:
+                with DISPATCHER.tracking_chats() as chat_ids:
+                    handle_message(update)
+            except Exception:
+                forget_update(update)
+                raise
+            # Replies go out from the outbox threads; on serverless hosts the instance may freeze once we return.
+            # Every chat this update queued to (the user, the admin, a channel, ...) is waited for, not other updates' backlogs.
+            if chat_ids and not DISPATCHER.flush(timeout=OUTBOX_FLUSH_TIMEOUT, chat_ids=chat_ids):
+                logging.warning("Messages to %s still queued after %ss", sorted(chat_ids, key=str), OUTBOX_FLUSH_TIMEOUT)
             return "ok", 200
         except Exception as e:
             logging.error("Error handling request: %s", e)
@@ -106,3 +136,22 @@ def home():
 @app.route("/health", methods=["GET"])
 def health_check():
     return {"status": "ok"}, 200
+
+def is_ops_request():
+    """Whether the request carries OPS_SECRET; with no secret configured, the ops endpoints stay closed."""
+    token = request.headers.get("X-Ops-Secret") or request.args.get("token", "")
+    return bool(OPS_SECRET) and hmac.compare_digest(token.encode(), OPS_SECRET.encode())
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Queue depths and counters of the update workers (WEBHOOK_ASYNC=1) and of the outgoing messages."""
+    if not is_ops_request():
+        return "Not found", 404
+    return {"updates": update_queue.stats() if update_queue else None, "outbox": DISPATCHER.stats()}, 200
+
+@app.route("/warmup", methods=["GET"])
+def warmup():
+    """Loads the Gemini SDK and models; point a scheduled ping (with ?token=OPS_SECRET) here to keep an instance warm."""
+    if not is_ops_request():
+        return "Not found", 404
+    return {"status": "ok", "gemini": warm_up()}, 200
@@ -0,0 +1,69 @@
+# api/key_pool.py
+"""
+Bookkeeping for spreading Gemini requests over several API keys.
+
+Each key tracks how many requests it is serving right now. acquire() hands out
+the least busy key that is not cooling down; a key that hit a 429/quota error
+cools down for GEMINI_KEY_COOLDOWN seconds, doubling on each further strike
+(up to MAX_COOLDOWN) until a request on it succeeds again.
+"""
+import threading
+import time
+
+from .config import GEMINI_KEY_COOLDOWN
+
+MAX_COOLDOWN = 600
+
+
+class PooledKey:
+    """One API key with its models and load/cooldown state."""
+
+    def __init__(self, api_key, models):
+        self.api_key = api_key
+        self.models = models # kind ("usual", "vision") -> GenerativeModel bound to this key
+        self.in_flight = 0
+        self.strikes = 0 # Consecutive quota errors
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.quota_errors = 0
+        self.last_used = 0.0
+
+    @property
+    def label(self):
+        return f"...{self.api_key[-4:]}" # Never log whole keys
+
+
+class KeyPool:
+    def __init__(self, keys):
+        self.keys = keys
+        self._lock = threading.Lock()
+
+    def acquire(self, exclude=()):
+        """Returns the least busy key not cooling down and not in exclude, or None; counts it as in flight."""
+        with self._lock:
+            now = time.time()
+            candidates = [key for key in self.keys if key not in exclude and key.cooldown_until <= now]
+            if not candidates:
+                return None
+            key = min(candidates, key=lambda candidate: (candidate.in_flight, candidate.last_used))
+            key.in_flight += 1
+            key.requests += 1
+            key.last_used = now
+            return key
+
+    def release(self, key, quota_error=False):
+        """Ends a request on key; a quota error puts the key on cooldown."""
+        with self._lock:
+            key.in_flight -= 1
+            if quota_error:
+                key.strikes += 1
+                key.quota_errors += 1
+                key.cooldown_until = time.time() + min(MAX_COOLDOWN, GEMINI_KEY_COOLDOWN * 2 ** (key.strikes - 1))
+            else:
+                key.strikes = 0
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            return [{"key": key.label, "in_flight": key.in_flight, "requests": key.requests, "quota_errors": key.quota_errors,
+                     "cooldown_s": max(0, round(key.cooldown_until - now))} for key in self.keys]
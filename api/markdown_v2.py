@@ -0,0 +1,277 @@
+# api/markdown_v2.py
+"""
+Incremental Markdown -> Telegram MarkdownV2 conversion for streamed answers.
+
+md2tgmd.escape() rewrites a whole text with dozens of regex passes, so calling
+it on every fragment breaks markup that spans fragments, and calling it on the
+growing answer for every edit is quadratic. MarkdownV2Stream instead consumes
+Gemini's chunks one character at a time, escaping each character once and
+keeping a stack of the markup that is open (code blocks, inline code, bold,
+italic, strikethrough, headings). A character whose meaning depends on the
+next one (`*`, `` ` ``, `~`, `#` at a line start) is held back until that
+character arrives.
+
+    formatter = MarkdownV2Stream()
+    formatter.feed(chunk_text)
+    formatter.render()          # the message so far, with open markup closed
+    formatter.cut(4096)         # a complete message, split at a line or word break
+
+cut() closes the markup open at the split point and reopens it at the start
+of the rest, so every message parses on its own. Links are shown as text.
+"""
+
+ESCAPE_CHARS = set("_*[]()~`>#+-=|{}.!\\")
+CODE_ESCAPE_CHARS = set("`\\")
+CLOSERS = {"bold": "*", "italic": "_", "strike": "~", "code": "`", "pre": "```", "heading": "*"}
+MAX_LANGUAGE_CHARS = 20 # Longer text after an opening ``` is code, not a language name
+NEWLINE, SPACE, CHARACTER = 2, 1, 0 # Preference of split points
+
+
+class Markup:
+    """One open piece of markup; `index` is the position of its opening token."""
+    __slots__ = ("kind", "opener", "index")
+
+    def __init__(self, kind, opener, index):
+        self.kind = kind
+        self.opener = opener
+        self.index = index
+
+
+class MarkdownV2Stream:
+    def __init__(self):
+        self.pending = "" # Source characters held back until the next chunk decides what they mean
+        self.tokens = [] # MarkdownV2 output of the current message, one token per source character or markup
+        self.length = 0 # Characters in tokens
+        self.stack = [] # Open Markup, innermost last
+        self.snapshot = () # tuple(stack), rebuilt only when the stack changes
+        self.boundaries = [] # (token count, length, snapshot, preference, source position) after each character
+        self.at_line_start = True
+        self.source_position = 0 # Source characters consumed so far
+
+    # --- Parsing ---
+
+    def feed(self, text):
+        self.pending += text
+        self._consume(final=False)
+
+    def finish(self):
+        """Resolves the held-back characters at the end of the answer."""
+        self._consume(final=True)
+
+    def _consume(self, final):
+        s = self.pending
+        i = 0
+        while i < len(s):
+            boundaries = len(self.boundaries)
+            next_i = self._step(s, i, final)
+            if next_i is None:
+                break
+            self.source_position += next_i - i
+            i = next_i
+            if len(self.boundaries) > boundaries: # Record where in the source the new character ends
+                self.boundaries[-1] = self.boundaries[-1][:4] + (self.source_position,)
+        self.pending = s[i:]
+
+    def _step(self, s, i, final):
+        """Converts the markup or character at s[i]; returns the index after it, or None to wait for more text."""
+        n = len(s)
+        c = s[i]
+        top = self.stack[-1].kind if self.stack else None
+        held = not final and n - i < 3 and "```".startswith(s[i:]) # Could still become ```
+
+        if top == "pre":
+            if s.startswith("```", i):
+                self._close()
+                return i + 3
+            if held:
+                return None
+            self._emit(c, code=True)
+            return i + 1
+        if top == "code":
+            if c == "`":
+                self._close()
+            else:
+                self._emit(c, code=True)
+            return i + 1
+
+        if c == "`":
+            if held:
+                return None
+            if not s.startswith("```", i):
+                self._open("code", "`")
+                return i + 1
+            end = s.find("\n", i + 3)
+            if end == -1 and not final and n - i - 3 <= MAX_LANGUAGE_CHARS: # The language line may still be arriving
+                return None
+            info = s[i + 3:end].strip() if end != -1 and end - i - 3 <= MAX_LANGUAGE_CHARS else None
+            if info is not None and (not info or info.replace("-", "").replace("+", "").isalnum()):
+                self._open("pre", f"```{info}\n")
+                return end + 1
+            self._open("pre", "```\n")
+            return i + 3
+
+        if self.at_line_start:
+            if c == " ":
+                self._emit(c)
+                self.at_line_start = True
+                return i + 1
+            if c == "#":
+                j = i
+                while j < n and s[j] == "#":
+                    j += 1
+                if j == n and not final:
+                    return None
+                if j - i <= 6 and j < n and s[j] == " ":
+                    self._open("heading", "*")
+                    return j + 1
+            elif c in "*-+":
+                if i + 1 == n and not final:
+                    return None
+                if i + 1 < n and s[i + 1] == " ":
+                    self._emit_token("• ", SPACE)
+                    return i + 2
+
+        if c == "*":
+            if i + 1 == n and not final:
+                return None
+            bold_open = any(markup.kind == "bold" for markup in self.stack)
+            italic_open = any(markup.kind == "italic" for markup in self.stack)
+            if s.startswith("**", i):
+                if bold_open and italic_open:
+                    if i + 2 == n and not final: # A third * would close both
+                        return None
+                    if s.startswith("***", i): # ***x*** or *a **b***
+                        while any(markup.kind in ("bold", "italic") for markup in self.stack):
+                            self._close()
+                        return i + 3
+                if bold_open:
+                    self._close_through("bold") # Markup opened inside the bold ends with it
+                elif not any(markup.kind == "heading" for markup in self.stack): # A heading is bold already
+                    self._open("bold", "*")
+                return i + 2
+            if italic_open:
+                self._close_through("italic")
+                return i + 1
+            if i + 1 < n and not s[i + 1].isspace():
+                self._open("italic", "_")
+                return i + 1
+        elif c == "~":
+            if i + 1 == n and not final:
+                return None
+            if s.startswith("~~", i):
+                if any(markup.kind == "strike" for markup in self.stack):
+                    self._close_through("strike")
+                else:
+                    self._open("strike", "~")
+                return i + 2
+        elif c == "\n":
+            while any(markup.kind == "heading" for markup in self.stack): # A heading ends with its line
+                self._close()
+            self._emit(c)
+            self.at_line_start = True
+            return i + 1
+        self._emit(c)
+        return i + 1
+
+    # --- Output ---
+
+    def _set_stack(self):
+        self.snapshot = tuple(self.stack)
+
+    def _open(self, kind, opener):
+        self.tokens.append(opener)
+        self.length += len(opener)
+        self.stack.append(Markup(kind, opener, len(self.tokens) - 1))
+        self._set_stack()
+        self.at_line_start = False
+
+    def _close_through(self, kind):
+        """Closes the innermost open markup of `kind` and everything opened inside it."""
+        while self.stack:
+            closed = self.stack[-1].kind
+            self._close()
+            if closed == kind:
+                return
+
+    def _close(self):
+        markup = self.stack.pop()
+        self._set_stack()
+        if markup.index == len(self.tokens) - 1: # Nothing inside: drop the opener, Telegram rejects empty entities
+            self.length -= len(self.tokens.pop())
+        else:
+            self.tokens.append(CLOSERS[markup.kind])
+            self.length += len(CLOSERS[markup.kind])
+
+    def _emit(self, c, code=False):
+        token = "\\" + c if c in (CODE_ESCAPE_CHARS if code else ESCAPE_CHARS) else c
+        self._emit_token(token, NEWLINE if c == "\n" else SPACE if c == " " else CHARACTER)
+
+    def _emit_token(self, token, preference):
+        self.tokens.append(token)
+        self.length += len(token)
+        self.at_line_start = False
+        self.boundaries.append((len(self.tokens), self.length, self.snapshot, preference, self.source_position))
+
+    @staticmethod
+    def _closers(open_markup):
+        return "".join(CLOSERS[markup.kind] for markup in reversed(open_markup))
+
+    def _text_until(self, count, open_markup):
+        """tokens[:count] with the given open markup closed (markup still empty at that point is left out)."""
+        open_markup = list(open_markup)
+        while open_markup and open_markup[-1].index == count - 1:
+            open_markup.pop()
+            count -= 1
+        return "".join(self.tokens[:count]) + self._closers(open_markup)
+
+    @property
+    def total_length(self):
+        """Length of render() (at most; empty markup is not counted out)."""
+        return self.length + sum(len(CLOSERS[markup.kind]) for markup in self.stack)
+
+    def render(self):
+        """The current message as valid MarkdownV2, open markup closed."""
+        return self._text_until(len(self.tokens), self.stack)
+
+    def cut(self, limit=None):
+        """
+        Returns (message, source position) for the text so far, or for as much as fits in limit characters,
+        preferring a split after a line break, then after a space, in the second half of the limit.
+        The rest, with the open markup reopened, becomes the start of the next message.
+        """
+        if limit is None or self.total_length <= limit:
+            count, length, open_markup, source_position = len(self.tokens), self.length, self.snapshot, self.source_position
+        else:
+            best = {}
+            for boundary in reversed(self.boundaries):
+                count, length, open_markup, preference, _ = boundary
+                if length + sum(len(CLOSERS[markup.kind]) for markup in open_markup) > limit:
+                    continue
+                best.setdefault(preference, boundary)
+                if preference == NEWLINE or length < limit // 2:
+                    break
+            boundary = next((best[preference] for preference in (NEWLINE, SPACE) if preference in best and best[preference][1] >= limit // 2),
+                            best.get(CHARACTER) or best.get(SPACE) or best.get(NEWLINE))
+            if boundary is None: # Not even one character fits after the markup
+                boundary = self.boundaries[0]
+            count, length, open_markup, _, source_position = boundary
+
+        message = self._text_until(count, open_markup)
+        reopened = [markup.opener for markup in open_markup]
+        shift = len(reopened) - count
+        for markup in self.stack:
+            markup.index += shift
+        for position, markup in enumerate(open_markup):
+            markup.index = position # Their opener is now the reopening token
+        self.tokens = reopened + self.tokens[count:]
+        length_shift = sum(len(opener) for opener in reopened) - length
+        self.length += length_shift
+        self.boundaries = [(boundary_count + shift, boundary_length + length_shift, boundary_markup, preference, boundary_source)
+                           for boundary_count, boundary_length, boundary_markup, preference, boundary_source in self.boundaries
+                           if boundary_count > count]
+        return message, source_position
+
+    @property
+    def empty(self):
+        """True if the current message holds nothing but reopened markup."""
+        return not self.boundaries and not self.pending
@@ -1,56 +1,327 @@
 # api/preprocess_textbooks.py
+"""
+Builds the textbook indexes under api/textbook_index from the PDFs in api/textbooks.
+
+    python -m api.preprocess_textbooks [textbook_id ...] [--workers N] [--force]
+    python -m api.preprocess_textbooks --from-json [textbook_id ...] # Rebuild from the shipped JSON indexes, no PDFs needed
+    python -m api.preprocess_textbooks --from-json --tfidf # Also build tfidf.npz, needed only for SEARCH_MODE=tfidf
+
+Running it as a script (python api/preprocess_textbooks.py) works as well.
+
+Page text is extracted across a process pool, one book at a time (large PDFs are split
+into page-range shards, each released once spooled) and spooled to a raw page cache keyed on the PDF's content hash, so a change
+to the normalizer only re-runs normalization and indexing. Books whose PDF hash and
+PIPELINE_VERSION match the manifest are skipped. Pages are streamed from the cache
+into the JSON and binary index files rather than held in memory as a whole book.
+"""
 import PyPDF2
+import argparse
+import hashlib
 import json
 import os
+import re
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+if __package__ in (None, ""): # Run directly as a script: import the modules below as part of the api package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = "api"
+
+from .search_index import BinaryIndexWriter
+from .spelling import write_spelling_data
+from .tfidf_index import TFIDF_AVAILABLE, TFIDF_FILENAME, build_tfidf_index
+
+API_DIR = os.path.dirname(os.path.abspath(__file__))
+PDF_DIR = os.path.join(API_DIR, "textbooks")
+INDEX_DIR = os.path.join(API_DIR, "textbook_index")
+PAGE_CACHE_DIR = os.path.join(os.path.dirname(API_DIR), ".textbook_cache") # Raw extracted pages, not deployed
+MANIFEST_FILENAME = "manifest.json"
 
 TEXTBOOK_FILES = { # Define textbooks to pre-process and their filenames
+    "biology9": "biology9.pdf",
+    "chemistry9": "chemistry9.pdf",
+    "citizenship": "citizenship.pdf",
     "economics9": "economics9.pdf",
+    "english9": "english9.pdf",
+    "geography9": "geography9.pdf",
     "history9": "history9.pdf",
+    "physics9": "physics9.pdf",
 }
 
-def load_and_chunk_textbook(textbook_id, filepath):
-    """Loads a textbook, chunks text by page, and returns page-based chunks."""
+PIPELINE_VERSION = 4 # Bump whenever normalization or the index format changes; forces a rebuild of every book
+EXTRACTOR_VERSION = 1 # Bump when PDF text extraction changes; invalidates the raw page cache
+SHARD_PAGES = 25 # Pages per extraction task
+
+# Running headers/footers: lines in the first/last BOILERPLATE_EDGE_LINES lines of a page
+# that repeat (ignoring a leading/trailing page number) on at least BOILERPLATE_MIN_PAGES pages.
+# Lines ending in ":" ("Key Concept:") introduce content and are never treated as boilerplate.
+BOILERPLATE_EDGE_LINES = 2
+BOILERPLATE_MIN_PAGES = 4
+
+HYPHENATED_BREAK = re.compile(r"(\w)-[ \t]*\n[ \t]*([a-z])") # "poten-\ntial" -> "potential"
+SPACE_RUNS = re.compile(r"[ \t\u00a0]+")
+BLANK_LINE_RUNS = re.compile(r"\n{3,}")
+PAGE_NUMBER_EDGES = re.compile(r"^\d+\s+|\s+\d+$")
+
+
+def _clean_lines(text):
+    """Joins words hyphenated across line breaks, collapses space runs and strips every line."""
+    text = HYPHENATED_BREAK.sub(r"\1\2", text)
+    return [SPACE_RUNS.sub(" ", line).strip() for line in text.split("\n")]
+
+
+def _boilerplate_key(line):
+    return PAGE_NUMBER_EDGES.sub("", line).lower()
+
+
+def _edge_lines(lines):
+    non_empty = [line for line in lines if line]
+    return non_empty[:BOILERPLATE_EDGE_LINES] + non_empty[-BOILERPLATE_EDGE_LINES:]
+
+
+def find_boilerplate(page_texts):
+    """Returns the boilerplate keys of running header/footer lines across an iterable of raw page texts."""
+    edge_counts = Counter()
+    for text in page_texts:
+        edge_counts.update({_boilerplate_key(line) for line in _edge_lines(_clean_lines(text or ""))})
+    return {key for key, count in edge_counts.items()
+            if key and not key.endswith(":") and count >= BOILERPLATE_MIN_PAGES}
+
+
+def normalize_page(page_number, text, boilerplate):
+    """
+    Returns the normalized chunk for one raw page, with a pre-lowercased "search_text" copy.
+    Only the first edge line of each boilerplate key is dropped, so a section heading printed
+    right under a running header with the same title survives.
+    """
+    lines = _clean_lines(text or "")
+    edges = set(_edge_lines(lines))
+    kept, removed = [], set()
+    for line in lines:
+        key = _boilerplate_key(line)
+        if line in edges and key in boilerplate and key not in removed:
+            removed.add(key)
+        else:
+            kept.append(line)
+    normalized_text = BLANK_LINE_RUNS.sub("\n\n", "\n".join(kept)).strip()
+    return {"page_number": page_number, "text": normalized_text, "search_text": normalized_text.lower()}
+
+
+def write_index_files(textbook_id, chunks, index_dir=INDEX_DIR):
+    """
+    Streams normalized chunks (ascending pages) into the JSON index and its binary copy; returns the page count.
+    The JSON keeps only page texts and sections; its loader rebuilds the postings from the text.
+    """
+    os.makedirs(index_dir, exist_ok=True) # Create index directory if it doesn't exist
+    index_filepath = os.path.join(index_dir, f"{textbook_id}_index.json")
+    binary_filepath = os.path.join(index_dir, f"{textbook_id}_index.bin")
+
+    # Write to temporary files and swap them in, so a failed run never leaves a half-written index behind
+    writer = BinaryIndexWriter(binary_filepath + ".tmp")
+    page_count = 0
     try:
-        with open(filepath, 'rb') as pdf_file:
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            pages_content = []
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text_content = page.extract_text()
-                pages_content.append({"page_number": page_num + 1, "text": text_content})
-            print(f"Textbook '{textbook_id}' processed: {len(pages_content)} pages extracted.")
-            return pages_content
-    except Exception as e:
-        print(f"Error processing textbook '{textbook_id}': {e}")
-        return None
-
-def create_index(textbook_id, pages_content, index_dir="textbook_index"):
-    """Creates and saves a simple JSON index for a textbook."""
-    if not os.path.exists(index_dir):
-        os.makedirs(index_dir) # Create index directory if it doesn't exist
+        with open(index_filepath + ".tmp", 'w') as outfile:
+            outfile.write(f'{{"textbook_id":{json.dumps(textbook_id)},"normalized":true,"chunks":[') # For now, chunks are just pages
+            for page_data in chunks:
+                if page_count:
+                    outfile.write(",")
+                json.dump({"page_number": page_data["page_number"], "text": page_data["text"]}, outfile, ensure_ascii=False, separators=(",", ":"))
+                writer.add_page(page_data)
+                page_count += 1
+            writer.close()
+            outfile.write('],"sections":') # Unit/section spans, in book order: the table of contents
+            json.dump(writer.sections, outfile, ensure_ascii=False, separators=(",", ":"))
+            outfile.write("}")
 
+        os.replace(index_filepath + ".tmp", index_filepath) # JSON stays as the readable fallback
+        os.replace(binary_filepath + ".tmp", binary_filepath) # Loaded with mmap by textbook_processor
+    except BaseException:
+        writer.abort()
+        for temp_filepath in (index_filepath + ".tmp", binary_filepath + ".tmp"):
+            if os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+        raise
+    print(f"Index for textbook '{textbook_id}' saved to '{index_filepath}' and '{binary_filepath}' ({page_count} pages)")
+
+    spelling_filepath = os.path.join(index_dir, f"{textbook_id}_spell.bin") # Deletion dictionary for typo correction
+    write_spelling_data({token: len(token_postings) for token, token_postings in writer.postings.items()}, spelling_filepath)
+    return page_count
+
+
+def create_index(textbook_id, pages_content, index_dir=INDEX_DIR):
+    """Creates and saves a JSON index for a textbook plus its compact binary (mmap) copy."""
+    return write_index_files(textbook_id, sorted(pages_content, key=lambda c: c["page_number"]), index_dir)
+
+
+def convert_json_index(textbook_id, index_dir=INDEX_DIR):
+    """
+    Rewrites every index file of a book from its existing JSON index (for books whose PDF is not at hand).
+    Pages of an index written before normalization existed (not marked "normalized") are normalized first.
+    """
     index_filepath = os.path.join(index_dir, f"{textbook_id}_index.json")
-    index_data = {
-        "textbook_id": textbook_id,
-        "chunks": pages_content # For now, chunks are just pages
-    }
+    with open(index_filepath, 'r') as infile:
+        index_data = json.load(infile)
+    chunks = sorted(index_data["chunks"], key=lambda c: c["page_number"])
+    if not index_data.get("normalized"):
+        boilerplate = find_boilerplate(page_data["text"] for page_data in chunks)
+        print(f"Normalizing '{textbook_id}': {len(boilerplate)} running header/footer lines removed.")
+        chunks = [normalize_page(page_data["page_number"], page_data["text"], boilerplate) for page_data in chunks]
+    return write_index_files(textbook_id, chunks, index_dir)
+
+
+def file_sha256(filepath):
+    """Returns the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-    with open(index_filepath, 'w') as outfile:
-        json.dump(index_data, outfile, indent=4) # Save index to JSON file
-    print(f"Index for textbook '{textbook_id}' saved to '{index_filepath}'")
+
+def pdf_page_count(filepath):
+    with open(filepath, 'rb') as pdf_file:
+        return len(PyPDF2.PdfReader(pdf_file).pages)
+
+
+def extract_page_range(filepath, first_page, last_page):
+    """Worker task: extracts [(page_number, text), ...] for pages first_page..last_page-1 (0-based) of a PDF."""
+    with open(filepath, 'rb') as pdf_file:
+        pdf_reader = PyPDF2.PdfReader(pdf_file)
+        return [(page_num + 1, pdf_reader.pages[page_num].extract_text() or "") for page_num in range(first_page, last_page)]
+
+
+def _page_cache_path(cache_dir, textbook_id, pdf_hash):
+    return os.path.join(cache_dir, f"{textbook_id}-{pdf_hash[:16]}-x{EXTRACTOR_VERSION}.jsonl")
+
+
+def _spool_pages(page_batches, cache_path):
+    """Writes batches of (page_number, text) to the raw page cache, one JSON line per page."""
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path + ".tmp", 'w') as outfile:
+        for batch in page_batches:
+            for page_number, text in batch:
+                outfile.write(json.dumps({"page_number": page_number, "text": text}, ensure_ascii=False) + "\n")
+    os.replace(cache_path + ".tmp", cache_path)
+
+
+def _shard_results(shards):
+    """Yields the pages of each extraction shard in order, dropping every future once consumed so its pages can be freed."""
+    while shards:
+        yield shards.pop(0).result()
+
+
+def _cached_pages(cache_path):
+    with open(cache_path, 'r') as infile:
+        for line in infile:
+            yield json.loads(line)
+
+
+def _normalized_cached_pages(cache_path):
+    """Two streaming passes over the raw page cache: find running headers/footers, then yield normalized chunks."""
+    boilerplate = find_boilerplate(page_data["text"] for page_data in _cached_pages(cache_path))
+    for page_data in _cached_pages(cache_path):
+        yield normalize_page(page_data["page_number"], page_data["text"], boilerplate)
+
+
+def _load_manifest(index_dir):
+    try:
+        with open(os.path.join(index_dir, MANIFEST_FILENAME), 'r') as infile:
+            return json.load(infile)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _save_manifest(index_dir, manifest):
+    with open(os.path.join(index_dir, MANIFEST_FILENAME), 'w') as outfile:
+        json.dump(manifest, outfile, indent=4, sort_keys=True)
+
+
+def write_tfidf_index(index_dir=INDEX_DIR):
+    """Rebuilds the character n-gram TF-IDF matrix over every JSON index in index_dir."""
+    if not TFIDF_AVAILABLE:
+        print("NumPy is not installed; skipping the TF-IDF index.")
+        return
+    books = []
+    for filename in sorted(os.listdir(index_dir)):
+        if filename.endswith("_index.json"):
+            with open(os.path.join(index_dir, filename), 'r') as infile:
+                books.append((filename[:-len("_index.json")], json.load(infile)["chunks"]))
+    tfidf_filepath = os.path.join(index_dir, TFIDF_FILENAME)
+    build_tfidf_index(books, tfidf_filepath)
+    print(f"TF-IDF index over {len(books)} textbooks saved to '{tfidf_filepath}'")
+
+
+def preprocess_textbooks(textbook_ids, pdf_dir=PDF_DIR, index_dir=INDEX_DIR, cache_dir=PAGE_CACHE_DIR,
+                         workers=None, shard_pages=SHARD_PAGES, force=False, tfidf=False):
+    """Extracts, normalizes and indexes the given textbooks, skipping those already up to date; with tfidf, refreshes tfidf.npz."""
+    manifest = _load_manifest(index_dir)
+    processed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # One book at a time, so only that book's extracted pages are ever held in memory
+        for textbook_id in textbook_ids:
+            filepath = os.path.join(pdf_dir, TEXTBOOK_FILES.get(textbook_id, f"{textbook_id}.pdf"))
+            if not os.path.exists(filepath):
+                print(f"Skipping '{textbook_id}': PDF not found at '{filepath}'")
+                continue
+            entry = {"pdf_sha256": file_sha256(filepath), "pipeline_version": PIPELINE_VERSION}
+            index_files_exist = all(os.path.exists(os.path.join(index_dir, f"{textbook_id}_index.{ext}")) for ext in ("json", "bin"))
+            if not force and index_files_exist and manifest.get(textbook_id) == entry:
+                print(f"'{textbook_id}' is up to date, skipping.")
+                continue
+
+            cache_path = _page_cache_path(cache_dir, textbook_id, entry["pdf_sha256"])
+            try:
+                if force or not os.path.exists(cache_path):
+                    page_count = pdf_page_count(filepath)
+                    shards = [executor.submit(extract_page_range, filepath, first_page, min(first_page + shard_pages, page_count))
+                              for first_page in range(0, page_count, shard_pages)]
+                    print(f"--- Extracting '{textbook_id}' ({page_count} pages, {len(shards)} shards) ---")
+                    _spool_pages(_shard_results(shards), cache_path) # Shards consumed in page order
+                write_index_files(textbook_id, _normalized_cached_pages(cache_path), index_dir)
+                manifest[textbook_id] = entry
+                _save_manifest(index_dir, manifest)
+                processed.append(textbook_id)
+            except Exception as e:
+                print(f"Preprocessing for '{textbook_id}' failed: {e}")
+
+    if tfidf and (processed or not os.path.exists(os.path.join(index_dir, TFIDF_FILENAME))):
+        write_tfidf_index(index_dir) # Spans all books, so any rebuilt book invalidates it
+    return processed
 
 
 def preprocess_all_textbooks():
     """Pre-processes all textbooks defined in TEXTBOOK_FILES."""
-    for textbook_id, filename in TEXTBOOK_FILES.items():
-        print(f"--- Pre-processing textbook '{textbook_id}' from '{filename}' ---")
-        filepath = f"textbooks/{filename}" # Assuming PDFs are in api/ folder
-        pages_content = load_and_chunk_textbook(textbook_id, filepath)
-        if pages_content:
-            create_index(textbook_id, pages_content)
-        else:
-            print(f"Preprocessing for '{textbook_id}' failed.")
+    return preprocess_textbooks(list(TEXTBOOK_FILES))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the textbook indexes from their PDFs.")
+    parser.add_argument("textbook_ids", nargs="*", help="textbooks to process (default: all of TEXTBOOK_FILES)")
+    parser.add_argument("--pdf-dir", default=PDF_DIR)
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    parser.add_argument("--cache-dir", default=PAGE_CACHE_DIR, help="raw extracted page cache")
+    parser.add_argument("--workers", type=int, default=None, help="extraction processes (default: CPU count)")
+    parser.add_argument("--shard-pages", type=int, default=SHARD_PAGES, help="pages per extraction task")
+    parser.add_argument("--force", action="store_true", help="re-extract and rebuild even if up to date")
+    parser.add_argument("--from-json", action="store_true", help="rebuild from the existing JSON indexes instead of the PDFs")
+    parser.add_argument("--tfidf", action="store_true", help="also build tfidf.npz (only SEARCH_MODE=tfidf reads it; not shipped)")
+    args = parser.parse_args(argv)
+
+    if args.from_json:
+        textbook_ids = args.textbook_ids or [textbook_id for textbook_id in TEXTBOOK_FILES
+                                             if os.path.exists(os.path.join(args.index_dir, f"{textbook_id}_index.json"))]
+        for textbook_id in textbook_ids:
+            convert_json_index(textbook_id, args.index_dir)
+        if args.tfidf:
+            write_tfidf_index(args.index_dir)
+        print(f"Rebuilt {len(textbook_ids)} textbook indexes from JSON.")
+        return
+
+    processed = preprocess_textbooks(args.textbook_ids or list(TEXTBOOK_FILES), args.pdf_dir, args.index_dir,
+                                     args.cache_dir, args.workers, args.shard_pages, args.force, args.tfidf)
+    print(f"Textbook pre-processing and indexing complete ({len(processed)} rebuilt).")
+
 
 if __name__ == "__main__":
-    preprocess_all_textbooks()
-    print("Textbook pre-processing and indexing complete.")
+    main()
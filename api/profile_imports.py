@@ -0,0 +1,89 @@
+# api/profile_imports.py
+"""
+Import-time profile of the web app, to catch cold-start regressions.
+
+    python -m api.profile_imports [--top 15] [--budget-ms 400] [--output run.json] [--baseline old.json]
+
+Imports api.index in a fresh interpreter with `python -X importtime` and reports
+the total import time and the modules with the largest cumulative time. With
+--budget-ms the exit status is 1 when the total exceeds the budget, so the
+check can run in CI. --output saves the report as JSON; --baseline compares
+the run against such a file.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+TARGET_MODULE = "api.index"
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def profile_imports(module=TARGET_MODULE):
+    """Returns {module name: (self µs, cumulative µs)} for one cold import of module."""
+    env = {**os.environ, "BOT_TOKEN": os.environ.get("BOT_TOKEN", "profile"), "GEMINI_WARMUP": "0"}
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=REPO_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def build_report(timings, module=TARGET_MODULE, top=15):
+    ordered = sorted(timings.items(), key=lambda item: item[1][1], reverse=True)
+    return {
+        "module": module,
+        "total_ms": round(timings[module][1] / 1000, 1),
+        "modules_imported": len(timings),
+        "top": {name: round(cumulative_us / 1000, 1) for name, (_, cumulative_us) in ordered[:top]},
+    }
+
+
+def print_report(report, baseline=None):
+    """Prints the total and the slowest modules (cumulative ms); with a baseline, each value is followed by its change."""
+    def cell(value, old_value):
+        if old_value is None:
+            return f"{value}"
+        change = round(value - old_value, 1)
+        return f"{value} ({'+' if change >= 0 else ''}{change})"
+
+    baseline = baseline or {}
+    print(f"import {report['module']}: {cell(report['total_ms'], baseline.get('total_ms'))} ms, "
+          f"{cell(report['modules_imported'], baseline.get('modules_imported'))} modules")
+    for name, milliseconds in report["top"].items():
+        print(f"  {cell(milliseconds, baseline.get('top', {}).get(name)):>16} ms  {name}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profile the import time of the web app.")
+    parser.add_argument("--module", default=TARGET_MODULE)
+    parser.add_argument("--top", type=int, default=15, help="number of slowest modules to list")
+    parser.add_argument("--budget-ms", type=float, help="exit with status 1 if the total import time is above this")
+    parser.add_argument("--output", help="save the report as JSON")
+    parser.add_argument("--baseline", help="report JSON of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    report = build_report(profile_imports(args.module), args.module, args.top)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as infile:
+            baseline = json.load(infile)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=4)
+    if args.budget_ms is not None and report["total_ms"] > args.budget_ms:
+        print(f"Import time {report['total_ms']} ms is over the budget of {args.budget_ms} ms.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
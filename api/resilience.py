@@ -0,0 +1,94 @@
+# api/resilience.py
+"""
+Retries and circuit breaking for calls to upstream services.
+
+retry_call() retries only errors that are worth retrying (timeouts, 500/503)
+with full-jitter exponential backoff, and never past an optional deadline. CircuitBreaker counts such failures and,
+after `failure_threshold` in a row, fails every call immediately for
+`reset_timeout` seconds instead of letting requests queue behind a service
+that is down; then a single trial call decides whether it closes again.
+"""
+import random
+import threading
+import time
+
+RETRYABLE_STATUS_CODES = (500, 502, 503, 504) # HTTP codes of google.api_core errors: InternalServerError ... DeadlineExceeded
+RETRYABLE_ERRORS = (ConnectionError, TimeoutError)
+MIN_ATTEMPT_SECONDS = 1.0 # No retry is started with less time than this left before the deadline
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit breaker is open."""
+
+
+def is_retryable(error):
+    return isinstance(error, RETRYABLE_ERRORS) or getattr(error, "code", None) in RETRYABLE_STATUS_CODES
+
+
+def retry_call(call, retries=2, base_delay=0.5, max_delay=4.0, deadline=None):
+    """
+    Returns call(), retrying retryable errors up to `retries` times after a random delay of up to base_delay * 2**attempt.
+    With a deadline (time.monotonic() value), no retry starts once less than MIN_ATTEMPT_SECONDS would be left.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return call()
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            if deadline is not None and time.monotonic() + delay + MIN_ATTEMPT_SECONDS > deadline:
+                raise
+            print(f"Retrying after {type(e).__name__} in {delay:.2f}s (attempt {attempt + 1} of {retries}): {e}")
+            time.sleep(delay)
+
+
+class CircuitBreaker:
+    """Closed: calls pass. Open: calls fail fast. After reset_timeout one trial call is let through (half-open)."""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.time() - self.opened_at >= self.reset_timeout else "open"
+
+    def _before_call(self):
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self._trial_running):
+                raise CircuitOpenError(f"{self.name} is unavailable right now, please try again shortly.")
+            if state == "half-open":
+                self._trial_running = True
+
+    def _after_call(self, error=None):
+        with self._lock:
+            self._trial_running = False
+            if error is None or not is_retryable(error): # Errors caused by the request itself say nothing about the service
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"Circuit breaker '{self.name}' opened after {self.failures} failures.")
+                self.opened_at = time.time() # (Re)open; a failed half-open trial restarts the wait
+
+    def call(self, call):
+        """Returns call(), or raises CircuitOpenError without calling while the circuit is open."""
+        self._before_call()
+        try:
+            result = call()
+        except Exception as e:
+            self._after_call(e)
+            raise
+        self._after_call()
+        return result
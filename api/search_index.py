@@ -0,0 +1,534 @@
+# api/search_index.py
+"""
+Positional inverted index over textbook pages.
+
+Each textbook index maps a token to the pages it occurs on and the token
+positions inside each page, so a concept lookup only touches the pages
+that actually hold the query terms. Postings are built once per textbook,
+either by preprocess_textbooks.py (stored in the JSON index) or on first
+load when an older index file does not carry them. Ranked lookups score
+pages with Okapi BM25 so callers can keep only the best few pages. BM25
+ignores stopwords, matches terms exactly except the last (which may be a
+partly typed word), keeps only pages holding most of the terms and drops
+pages scoring below BM25_MIN_SCORE, so a query the books do not cover
+finds nothing.
+
+preprocess_textbooks.py also writes a compact binary copy of each index
+(`<textbook_id>_index.bin`), which MappedTextbookIndex opens with mmap so a
+cold start neither parses the page text or the vocabulary nor keeps them resident:
+
+    header    BINARY_HEADER, all offsets relative to the start of the file
+    text      UTF-8 page texts back to back
+    tokens    UTF-8 tokens back to back, in sorted order
+    terms     term_count x TERM_ENTRY (token_start, token_end, postings_offset, page_count), sorted by token
+    postings  uint32 stream; per term and page: page_number, tf, positions...
+    pages     page_count x (page_number, text_start, text_end, token_count), uint32
+    sections  compact JSON list of unit/section spans (see sections.py)
+
+Tokens are looked up by binary search over the terms table, decoding only the
+few tokens compared.
+Sections are written in that order so pages can be streamed into the file.
+"""
+import heapq
+import json
+import math
+import mmap
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections.abc import Sequence
+
+from .sections import SectionDetector, detect_sections
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Okapi BM25 parameters (the usual defaults)
+BM25_K1 = 1.2
+BM25_B = 0.75
+PHRASE_BOOST = 0.5 # Extra weight for pages holding the whole multi-word phrase
+BM25_MIN_SCORE = 1.0 # Pages scoring lower match only words found on most pages
+MIN_PREFIX_CHARS = 3 # Shortest last query term that also matches longer words
+
+STOPWORDS = frozenset("""
+a about above after again against all also am an and any are as at be because been before being below between both but by
+can could did do does doing down during each explain few for from further had has have having he her here hers him his how
+i if in into is it its itself just me more most my no nor not of off on once only or other our out over own please same she
+should so some such tell than that the their them then there these they this those through to too under until up very was
+we were what when where which while who whom why will with would you your
+""".split())
+
+BINARY_MAGIC = b"TBIX"
+BINARY_VERSION = 3
+# magic, version, page_count, term_count, then (offset, length) of the pages, text, tokens, terms, postings and sections sections
+BINARY_HEADER = struct.Struct("<4sHxxII12Q")
+PAGE_ENTRY = struct.Struct("<4I")
+TERM_ENTRY = struct.Struct("<4I")
+
+# Approximate resident bytes per indexed term, token position and page text character (measured with tracemalloc)
+TERM_BYTES = 200
+POSITION_BYTES = 100
+TEXT_CHAR_BYTES = 2
+MAPPED_PAGE_BYTES = 350 # Page length, text span and sections share of a MappedTextbookIndex
+
+
+def tokenize(text):
+    """Splits text into lowercase word tokens."""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def query_terms(query):
+    """
+    Returns the BM25 terms of a query as [(token, prefix)]: stopwords dropped, duplicates removed,
+    numbers dropped next to words (the phrase boost still sees them), and prefix set only on the
+    last term, which may be a partly typed word ("photosynth").
+    """
+    tokens = [token for token in dict.fromkeys(tokenize(query)) if token not in STOPWORDS]
+    tokens = [token for token in tokens if not token.isdigit()] or tokens
+    return [(token, position == len(tokens) - 1 and len(token) >= MIN_PREFIX_CHARS and not token.isdigit())
+            for position, token in enumerate(tokens)]
+
+
+def add_page_postings(postings, page_data):
+    """Adds one page's token positions to `postings` (pages in ascending order) and returns its token count."""
+    page_positions = {}
+    # Normalized indexes carry a pre-lowercased copy of each page
+    page_tokens = TOKEN_PATTERN.findall(page_data["search_text"]) if "search_text" in page_data else tokenize(page_data["text"])
+    for position, token in enumerate(page_tokens):
+        page_positions.setdefault(token, []).append(position)
+    for token, positions in page_positions.items():
+        postings.setdefault(token, []).append([page_data["page_number"], positions])
+    return len(page_tokens)
+
+
+def build_postings(chunks):
+    """Builds {token: [[page_number, [positions...]], ...]} from page chunks, pages ascending."""
+    postings = {}
+    for page_data in sorted(chunks, key=lambda c: c["page_number"]):
+        add_page_postings(postings, page_data)
+    return postings
+
+
+def bm25_idf(page_count, document_frequency):
+    return math.log(1 + (page_count - document_frequency + 0.5) / (document_frequency + 0.5))
+
+
+def bm25_term_score(idf, tf, page_length, avg_page_length):
+    length_norm = 1 - BM25_B + BM25_B * page_length / avg_page_length
+    return idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm)
+
+
+def _uint32_array(values):
+    """Little-endian uint32 array, as stored in binary index postings."""
+    values = array("I", values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+class BinaryIndexWriter:
+    """Streams pages (ascending) into a binary index file; postings stay in memory until close()."""
+
+    def __init__(self, filepath):
+        self.postings = {}
+        self.sections = None # Set by close()
+        self._section_detector = SectionDetector()
+        self._outfile = open(filepath, "wb")
+        self._outfile.write(b"\0" * BINARY_HEADER.size) # Header is filled in by close()
+        self._page_table = bytearray()
+        self._page_count = 0
+        self._text_offset = self._outfile.tell()
+        self._text_length = 0
+
+    def add_page(self, page_data):
+        """Appends a page's text to the text section and its tokens to the postings."""
+        token_count = add_page_postings(self.postings, page_data)
+        self._section_detector.add_page(page_data["page_number"], page_data["text"])
+        encoded_text = page_data["text"].encode("utf-8")
+        self._page_table += PAGE_ENTRY.pack(page_data["page_number"], self._text_length,
+                                            self._text_length + len(encoded_text), token_count)
+        self._outfile.write(encoded_text)
+        self._text_length += len(encoded_text)
+        self._page_count += 1
+
+    def _write_section(self, section):
+        self._outfile.write(b"\0" * (-self._outfile.tell() % 4)) # Keep sections aligned for memoryview.cast()
+        offset = self._outfile.tell()
+        self._outfile.write(section)
+        return offset, len(section)
+
+    def close(self):
+        """Writes the terms, postings, page table and unit/section sections, then the header."""
+        tokens = bytearray()
+        terms = bytearray()
+        postings_stream = array("I")
+        for token in sorted(self.postings):
+            encoded_token = token.encode("utf-8")
+            terms += TERM_ENTRY.pack(len(tokens), len(tokens) + len(encoded_token), len(postings_stream), len(self.postings[token]))
+            tokens += encoded_token
+            for page_number, positions in self.postings[token]:
+                postings_stream.extend(_uint32_array([page_number, len(positions), *positions]))
+
+        tokens_section = self._write_section(bytes(tokens))
+        terms_section = self._write_section(bytes(terms))
+        postings_section = self._write_section(postings_stream.tobytes())
+        pages_section = self._write_section(bytes(self._page_table))
+        self.sections = self._section_detector.finish()
+        sections_section = self._write_section(json.dumps(self.sections, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        self._outfile.seek(0)
+        self._outfile.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, self._page_count, len(self.postings),
+                                               *pages_section, self._text_offset, self._text_length,
+                                               *tokens_section, *terms_section, *postings_section, *sections_section))
+        self._outfile.close()
+
+
+    def abort(self):
+        """Closes the file unfinished (after an error; the caller removes it)."""
+        self._outfile.close()
+
+
+def write_binary_index(chunks, filepath):
+    """Writes page chunks in the mmap-able binary index format and returns their postings."""
+    writer = BinaryIndexWriter(filepath)
+    for page_data in sorted(chunks, key=lambda c: c["page_number"]):
+        writer.add_page(page_data)
+    writer.close()
+    return writer.postings
+
+
+class TextbookIndex:
+    """Page texts of one textbook plus its positional postings and unit/section spans (its table of contents)."""
+
+    def __init__(self, textbook_id, chunks, postings=None, sections=None):
+        self.textbook_id = textbook_id
+        self.chunks = chunks
+        self.postings = postings if postings is not None else build_postings(chunks)
+        self.sections = sections if sections is not None else detect_sections(chunks)
+        self.vocabulary = sorted(self.postings)
+        self.page_lengths = {page_data["page_number"]: 0 for page_data in chunks}
+        for token_postings in self.postings.values():
+            for page_number, positions in token_postings:
+                self.page_lengths[page_number] += len(positions)
+        self.avg_page_length = (sum(self.page_lengths.values()) / len(self.page_lengths)) if self.page_lengths else 0.0
+        # Direct page-number -> text array, so page lookups are O(1) instead of a scan over chunks
+        self.pages = [None] * (max(self.page_lengths, default=0) + 1)
+        for page_data in chunks:
+            self.pages[page_data["page_number"]] = page_data["text"]
+        self.memory_size = TERM_BYTES * len(self.postings) + POSITION_BYTES * sum(self.page_lengths.values()) + \
+            TEXT_CHAR_BYTES * sum(len(page_data["text"]) for page_data in chunks) # Estimate, for cache budgets
+
+    def token_postings(self, token):
+        """Returns [(page_number, positions), ...] for an indexed token."""
+        return self.postings[token]
+
+    def has_token(self, token):
+        """Returns True if `token` occurs in the textbook."""
+        return token in self.postings
+
+    def document_frequencies(self):
+        """Returns {token: number of pages containing it}."""
+        return {token: len(token_postings) for token, token_postings in self.postings.items()}
+
+    def page_text(self, page_number):
+        """Returns the text of a page, or "" for unknown pages."""
+        if 0 < page_number < len(self.pages):
+            return self.pages[page_number] or ""
+        return ""
+
+    def page_size(self, page_number):
+        """Returns the length of a page's text (an upper bound is enough; used to size sections cheaply)."""
+        return len(self.page_text(page_number))
+
+    def section_text(self, section):
+        """Returns the text of a section, from its start heading up to the next heading that ends it."""
+        parts = []
+        for page_number in range(section["start_page"], section["end_page"] + 1):
+            text = self.page_text(page_number)
+            start = section["start_offset"] if page_number == section["start_page"] else 0
+            end = section["end_offset"] if page_number == section["end_page"] and section["end_offset"] is not None else len(text)
+            parts.append(text[start:end])
+        return "\n\n".join(part.strip() for part in parts if part.strip())
+
+    def concept_section(self, query, page_number, max_chars):
+        """
+        Returns (section, section_text) for the smallest section spanning `page_number` that
+        mentions every query term and fits in max_chars, or None if there is no such section.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return None
+        candidates = []
+        for section in self.sections:
+            if section["start_page"] <= page_number <= section["end_page"]:
+                size = sum(self.page_size(section_page) for section_page in range(section["start_page"], section["end_page"] + 1))
+                if size <= 2 * max_chars: # Only the ends of the first and last page are cut off
+                    candidates.append((size, section))
+
+        for _, section in sorted(candidates, key=lambda candidate: candidate[0]):
+            text = self.section_text(section)
+            if len(text) <= max_chars and all(re.search(r"\b" + re.escape(token), text, re.IGNORECASE) for token in set(tokens)):
+                return section, text
+        return None
+
+    def passages(self, page_number, query, window_chars):
+        """Returns the parts of a page within `window_chars` of a query-term match, overlapping windows merged."""
+        text = self.page_text(page_number)
+        tokens = tokenize(query)
+        if not text or not tokens:
+            return []
+        pattern = re.compile(r"\b(?:" + "|".join(re.escape(token) for token in set(tokens)) + r")\w*", re.IGNORECASE)
+
+        spans = []
+        for match in pattern.finditer(text):
+            start, end = max(0, match.start() - window_chars), min(len(text), match.end() + window_chars)
+            if spans and start <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], end)
+            else:
+                spans.append([start, end])
+        return [text[start:end].strip() for start, end in spans]
+
+    def expand_token(self, token):
+        """Returns indexed tokens starting with `token` (keeps the old substring search matching 'cell' in 'cells')."""
+        start = bisect_left(self.vocabulary, token)
+        matches = []
+        for vocab_token in self.vocabulary[start:]:
+            if not vocab_token.startswith(token):
+                break
+            matches.append(vocab_token)
+        return matches
+
+    def prefix_postings(self, token):
+        """Yields the postings of every indexed token starting with `token`."""
+        return (self.token_postings(vocab_token) for vocab_token in self.expand_token(token))
+
+    def token_positions(self, token):
+        """Returns {page_number: set(positions)} for every indexed token starting with `token`."""
+        pages = {}
+        for token_postings in self.prefix_postings(token):
+            for page_number, positions in token_postings:
+                pages.setdefault(page_number, set()).update(positions)
+        return pages
+
+    def term_pages(self, token, prefix=False):
+        """Returns {page_number: positions} for `token` exactly, or for every indexed token starting with it if prefix."""
+        if prefix:
+            return self.token_positions(token)
+        try:
+            return dict(self.token_postings(token))
+        except KeyError:
+            return {}
+
+    def phrase_pages(self, phrase):
+        """Returns page numbers (ascending) where the tokens of `phrase` occur consecutively."""
+        tokens = tokenize(phrase)
+        if not tokens:
+            return []
+
+        token_pages = [self.token_positions(token) for token in tokens]
+        if not all(token_pages):
+            return []
+
+        # Intersect starting from the rarest term so only its pages are checked.
+        rarest = min(token_pages, key=len)
+        concept_pages = []
+        for page_number in sorted(rarest):
+            if not all(page_number in pages for pages in token_pages):
+                continue
+            first_positions = token_pages[0][page_number]
+            if any(all(start + offset in token_pages[offset][page_number] for offset in range(1, len(tokens)))
+                   for start in first_positions):
+                concept_pages.append(page_number)
+        return concept_pages
+
+    def rank_pages(self, query, top_k=5):
+        """Scores pages against `query` with BM25 and returns the top_k as [(page_number, score)], best first."""
+        terms = query_terms(query)
+        if not terms or not self.avg_page_length:
+            return []
+
+        page_count = len(self.page_lengths)
+        scores = {}
+        matched_terms = {}
+        for token, prefix in terms:
+            token_pages = self.term_pages(token, prefix)
+            if not token_pages:
+                continue
+            idf = bm25_idf(page_count, len(token_pages))
+            for page_number, positions in token_pages.items():
+                scores[page_number] = scores.get(page_number, 0.0) + \
+                    bm25_term_score(idf, len(positions), self.page_lengths[page_number], self.avg_page_length)
+                matched_terms[page_number] = matched_terms.get(page_number, 0) + 1
+        scores = {page_number: score for page_number, score in scores.items()
+                  if 2 * matched_terms[page_number] > len(terms)} # More than half of the terms
+
+        if len(terms) > 1:
+            for page_number in self.phrase_pages(query):
+                if page_number in scores:
+                    scores[page_number] *= 1 + PHRASE_BOOST
+
+        return heapq.nlargest(top_k, ((page_number, score) for page_number, score in scores.items() if score >= BM25_MIN_SCORE),
+                              key=lambda item: item[1])
+
+
+class MappedVocabulary(Sequence):
+    """Sorted tokens of a mapped terms table, decoded on access; slicing returns another lazy view."""
+
+    def __init__(self, tokens, terms, start=0, stop=None):
+        self._tokens = tokens
+        self._terms = terms
+        self._start = start
+        self._stop = len(terms) // TERM_ENTRY.size if stop is None else stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step != 1:
+                raise ValueError("MappedVocabulary only supports contiguous slices")
+            return MappedVocabulary(self._tokens, self._terms, self._start + start, self._start + max(start, stop))
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError(item)
+        token_start, token_end, _, _ = self.entry(item)
+        return str(self._tokens[token_start:token_end], "utf-8")
+
+    def entry(self, item):
+        """Returns the (token_start, token_end, postings_offset, page_count) entry of the item-th token of this view."""
+        return TERM_ENTRY.unpack_from(self._terms, (self._start + item) * TERM_ENTRY.size)
+
+
+class MappedTextbookIndex(TextbookIndex):
+    """TextbookIndex backed by a memory-mapped binary index file; page text and postings are sliced on demand."""
+
+    def __init__(self, textbook_id, filepath):
+        with open(filepath, "rb") as infile:
+            self._mmap = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, version, page_count, _, *offsets = BINARY_HEADER.unpack_from(view)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError(f"'{filepath}' is not a version {BINARY_VERSION} binary textbook index")
+        (pages_offset, pages_length), (text_offset, text_length), (tokens_offset, tokens_length), (terms_offset, terms_length), \
+            (postings_offset, postings_length), (sections_offset, sections_length) = zip(offsets[::2], offsets[1::2])
+
+        self.textbook_id = textbook_id
+        self._text = view[text_offset:text_offset + text_length]
+        self._postings = view[postings_offset:postings_offset + postings_length].cast("I")
+        if sys.byteorder != "little":
+            self._postings = array("I", self._postings.tobytes())
+            self._postings.byteswap()
+        self._tokens = view[tokens_offset:tokens_offset + tokens_length]
+        self.vocabulary = MappedVocabulary(self._tokens, view[terms_offset:terms_offset + terms_length])
+        self.sections = json.loads(str(view[sections_offset:sections_offset + sections_length], "utf-8"))
+
+        page_entries = [PAGE_ENTRY.unpack_from(view, pages_offset + i * PAGE_ENTRY.size) for i in range(page_count)]
+        self.page_lengths = {page_number: token_count for page_number, _, _, token_count in page_entries}
+        self.avg_page_length = (sum(self.page_lengths.values()) / page_count) if page_count else 0.0
+        self._page_spans = [None] * (max(self.page_lengths, default=0) + 1)
+        for page_number, start, end, _ in page_entries:
+            self._page_spans[page_number] = (start, end)
+        self.memory_size = MAPPED_PAGE_BYTES * page_count # Text, vocabulary and postings stay in the page cache, not the heap
+
+    def _term_number(self, token):
+        term_number = bisect_left(self.vocabulary, token)
+        return term_number if term_number < len(self.vocabulary) and self.vocabulary[term_number] == token else None
+
+    def has_token(self, token):
+        return self._term_number(token) is not None
+
+    def token_postings(self, token):
+        """Decodes [(page_number, positions), ...] for a token straight from the mapped postings stream."""
+        term_number = self._term_number(token)
+        if term_number is None:
+            raise KeyError(token)
+        _, _, offset, page_count = self.vocabulary.entry(term_number)
+        return self._read_postings(offset, page_count)
+
+    def prefix_postings(self, token):
+        """Walks the sorted terms table once from the first token >= `token`, without decoding the tokens."""
+        prefix = token.encode("utf-8")
+        for term_number in range(bisect_left(self.vocabulary, token), len(self.vocabulary)):
+            token_start, token_end, offset, page_count = self.vocabulary.entry(term_number)
+            if self._tokens[token_start:min(token_end, token_start + len(prefix))] != prefix:
+                break
+            yield self._read_postings(offset, page_count)
+
+    def _read_postings(self, offset, page_count):
+        token_postings = []
+        for _ in range(page_count):
+            page_number, tf = self._postings[offset], self._postings[offset + 1]
+            token_postings.append((page_number, self._postings[offset + 2:offset + 2 + tf]))
+            offset += 2 + tf
+        return token_postings
+
+    def document_frequencies(self):
+        return {token: self.vocabulary.entry(term_number)[3] for term_number, token in enumerate(self.vocabulary)}
+
+    def page_text(self, page_number):
+        """Decodes one page's text from the mapped text section."""
+        if 0 < page_number < len(self._page_spans) and self._page_spans[page_number]:
+            start, end = self._page_spans[page_number]
+            return str(self._text[start:end], "utf-8")
+        return ""
+
+    def page_size(self, page_number):
+        """Returns the UTF-8 byte length of a page without decoding it."""
+        if 0 < page_number < len(self._page_spans) and self._page_spans[page_number]:
+            start, end = self._page_spans[page_number]
+            return end - start
+        return 0
+
+
+class GlobalIndex:
+    """
+    Scores a query against the pages of several textbooks at once.
+
+    BM25 statistics (page count, document frequencies, average page length) are
+    pooled over every book, so scores from different books are comparable.
+    """
+
+    def __init__(self, textbook_indexes):
+        self.indexes = {textbook_index.textbook_id: textbook_index for textbook_index in textbook_indexes}
+        self.page_count = sum(len(textbook_index.page_lengths) for textbook_index in self.indexes.values())
+        total_length = sum(sum(textbook_index.page_lengths.values()) for textbook_index in self.indexes.values())
+        self.avg_page_length = (total_length / self.page_count) if self.page_count else 0.0
+
+    def rank_pages(self, query, top_k=5):
+        """
+        Returns the top_k [(textbook_id, page_number, score)] over all books, best first.
+        Only pages containing every query term are considered.
+        """
+        terms = query_terms(query)
+        if not terms or not self.avg_page_length:
+            return []
+
+        token_matches = {token: {textbook_id: textbook_index.term_pages(token, prefix)
+                                 for textbook_id, textbook_index in self.indexes.items()}
+                         for token, prefix in terms}
+        scores = {}
+        matched_terms = {}
+        for token, book_pages in token_matches.items():
+            document_frequency = sum(len(token_pages) for token_pages in book_pages.values())
+            if not document_frequency:
+                return [] # A term found in no book at all: nothing covers the whole query
+            idf = bm25_idf(self.page_count, document_frequency)
+            for textbook_id, token_pages in book_pages.items():
+                page_lengths = self.indexes[textbook_id].page_lengths
+                for page_number, positions in token_pages.items():
+                    key = (textbook_id, page_number)
+                    scores[key] = scores.get(key, 0.0) + \
+                        bm25_term_score(idf, len(positions), page_lengths[page_number], self.avg_page_length)
+                    matched_terms[key] = matched_terms.get(key, 0) + 1
+
+        scores = {key: score for key, score in scores.items() if matched_terms[key] == len(terms) and score >= BM25_MIN_SCORE}
+        if len(terms) > 1:
+            for textbook_id, textbook_index in self.indexes.items():
+                for page_number in textbook_index.phrase_pages(query):
+                    if (textbook_id, page_number) in scores:
+                        scores[(textbook_id, page_number)] *= 1 + PHRASE_BOOST
+
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [(textbook_id, page_number, score) for (textbook_id, page_number), score in best]
@@ -0,0 +1,104 @@
+# api/sections.py
+"""
+Unit and section heading detection for textbook pages.
+
+Headings such as "Unit 3: Cells" or "2.4 Unit conversion" start a section
+that runs until the next heading of the same or a higher level, so units
+contain their numbered sections and "3.2" contains "3.2.1". Each section is
+stored as a dict with its page span and character offsets:
+
+    {"section_id": "2.4", "title": "Unit conversion", "level": 2,
+     "start_page": 33, "start_offset": 120, "end_page": 36, "end_offset": 45}
+
+where the end is exclusive and an end_offset of None means "to the end of
+end_page". The list, in book order, doubles as the book's table of contents.
+"""
+import re
+
+NUMBERED_HEADING = re.compile(r"^((?:1\d|[1-9])(?:\.\d{1,2}){1,3})\.?\s+([A-Z].{2,100})$")
+UNIT_HEADING = re.compile(r"^unit\s+(\d{1,2}|one|two|three|four|five|six|seven|eight|nine|ten)\b\s*(?:[:.|-]\s*)?([A-Z].*)?$", re.IGNORECASE)
+UNIT_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10}
+TOC_ENTRY = re.compile(r"(\.\s?){4,}|\s\d{1,3}$") # Dot leaders or a trailing page number
+TOC_MIN_ENTRIES = 3 # A page with this many table-of-contents style lines is skipped entirely
+UNIT_MAX_STEP = 2 # Units count up from 1 and may skip one whose heading was not extracted
+OVERVIEW_MIN_HEADINGS = 4 # Numbered headings on a page with this many are a unit overview, not section starts
+
+
+def _heading(line):
+    """Returns (number, title) if the line looks like a heading; units are numbered (n,), sections (n, m, ...)."""
+    unit_match = UNIT_HEADING.match(line)
+    if unit_match:
+        unit = unit_match.group(1).lower()
+        return (UNIT_WORDS[unit] if unit in UNIT_WORDS else int(unit),), (unit_match.group(2) or "").strip() or line
+    numbered_match = NUMBERED_HEADING.match(line)
+    if numbered_match:
+        return tuple(int(part) for part in numbered_match.group(1).split(".")), numbered_match.group(2).strip()
+    return None
+
+
+def _section_id(number):
+    return f"unit {number[0]}" if len(number) == 1 else ".".join(str(part) for part in number)
+
+
+class SectionDetector:
+    """Finds sections in pages fed in page order; call finish() after the last page."""
+
+    def __init__(self):
+        self.sections = []
+        self._open = [] # Sections not yet ended, outermost first
+        self._last_unit = None
+        self._last_number = None
+        self._last_page = None
+
+    def add_page(self, page_number, text):
+        self._last_page = page_number
+        headings = []
+        toc_entries = 0
+        offset = 0
+        for raw_line in text.split("\n"):
+            line = " ".join(raw_line.split())
+            heading = _heading(line) if line else None
+            if heading:
+                if TOC_ENTRY.search(line):
+                    toc_entries += 1 # Table of contents entry or running header ("2.4 Unit conversion 27")
+                else:
+                    headings.append((offset, heading))
+            offset += len(raw_line) + 1
+        if toc_entries >= TOC_MIN_ENTRIES:
+            return
+        if sum(len(number) > 1 for _, (number, _) in headings) >= OVERVIEW_MIN_HEADINGS:
+            headings = [heading for heading in headings if len(heading[1][0]) == 1]
+
+        for offset, (number, title) in headings:
+            # Headings only move forward, so running headers, cross references and page numbers glued to a heading are skipped
+            if len(number) == 1:
+                if not (self._last_unit or 0) < number[0] <= (self._last_unit or 0) + UNIT_MAX_STEP:
+                    continue
+                self._last_unit = number[0]
+            else:
+                if self._last_number is not None and not (self._last_number < number and number[0] <= self._last_number[0] + 1):
+                    continue
+                self._last_number = number
+            section_id, level = _section_id(number), len(number) - 1
+            while self._open and self._open[-1]["level"] >= level:
+                ended = self._open.pop()
+                ended["end_page"], ended["end_offset"] = page_number, offset
+            section = {"section_id": section_id, "title": title, "level": level,
+                       "start_page": page_number, "start_offset": offset, "end_page": None, "end_offset": None}
+            self.sections.append(section)
+            self._open.append(section)
+
+    def finish(self):
+        """Ends every open section at the end of the last page and returns all sections."""
+        for section in self._open:
+            section["end_page"], section["end_offset"] = self._last_page, None
+        self._open = []
+        return self.sections
+
+
+def detect_sections(chunks):
+    """Returns the sections of a list of page chunks."""
+    detector = SectionDetector()
+    for page_data in sorted(chunks, key=lambda c: c["page_number"]):
+        detector.add_page(page_data["page_number"], page_data["text"])
+    return detector.finish()
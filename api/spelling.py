@@ -0,0 +1,193 @@
+# api/spelling.py
+"""
+Typo-tolerant lookups against a textbook's vocabulary (SymSpell-style).
+
+Every vocabulary word is expanded into the strings reachable by deleting up
+to MAX_EDIT_DISTANCE characters from its first PREFIX_LENGTH characters. A
+misspelled query word is expanded the same way, so candidate corrections are
+found with hash lookups; only those few candidates get a real edit-distance
+check.
+
+The deletion dictionary is a compact binary table, written by
+preprocess_textbooks.py as `<textbook_id>_spell.bin` and opened with mmap, so
+a loaded corrector keeps almost nothing on the heap (it is built in memory on
+first use when that file is missing):
+
+    header      SPELL_HEADER, all offsets relative to the start of the file
+    words       UTF-8 correctable words back to back, sorted
+    word ends   uint32 per word: end offset of the word in the words section
+    counts      uint32 per word: number of pages holding it
+    buckets     uint32 x (bucket_count + 1): start of each bucket in the candidates section
+    candidates  uint32 word numbers; bucket crc32(delete) % bucket_count lists every word with that delete
+
+Deletes are not stored: words of deletes that share a bucket are merged, and
+the edit-distance check drops the extra candidates.
+"""
+import mmap
+import re
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+from collections.abc import Sequence
+
+MAX_EDIT_DISTANCE = 2
+PREFIX_LENGTH = 7
+MIN_WORD_LENGTH = 3 # Shorter words and words with digits are never corrected
+WORD_PATTERN = re.compile(r"^[^\W\d_]+$")
+
+SPELL_MAGIC = b"TBSP"
+SPELL_VERSION = 1
+# magic, version, word_count, bucket_count, then (offset, length) of the words, word ends, counts, buckets and candidates sections
+SPELL_HEADER = struct.Struct("<4sHxxII10Q")
+
+
+def is_correctable(word):
+    return len(word) >= MIN_WORD_LENGTH and bool(WORD_PATTERN.match(word))
+
+
+def _deletes(word):
+    """Returns the word prefix plus every string reachable from it by up to MAX_EDIT_DISTANCE deletions."""
+    prefix = word[:PREFIX_LENGTH]
+    deletes = {prefix}
+    frontier = {prefix}
+    for _ in range(MAX_EDIT_DISTANCE):
+        frontier = {variant[:i] + variant[i + 1:] for variant in frontier for i in range(len(variant))}
+        deletes |= frontier
+    return deletes
+
+
+def edit_distance(source, target, max_distance=MAX_EDIT_DISTANCE):
+    """Optimal string alignment distance (Levenshtein plus adjacent transpositions), or max_distance + 1 if larger."""
+    if abs(len(source) - len(target)) > max_distance:
+        return max_distance + 1
+    previous_previous = None
+    previous = list(range(len(target) + 1))
+    for i, source_char in enumerate(source, 1):
+        current = [i] + [0] * len(target)
+        for j, target_char in enumerate(target, 1):
+            cost = source_char != target_char
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and source_char == target[j - 2] and source[i - 2] == target_char:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+def _bucket(delete, bucket_count):
+    return zlib.crc32(delete.encode("utf-8")) % bucket_count
+
+
+def _uint32_bytes(values):
+    values = array("I", values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+
+def build_spelling_data(word_counts):
+    """Builds the binary deletion dictionary (see the module docstring) for {word: count} and returns its bytes."""
+    words = sorted(word for word in word_counts if is_correctable(word))
+    word_deletes = [_deletes(word) for word in words]
+    bucket_count = max(1, sum(map(len, word_deletes)) // 2)
+    buckets = [set() for _ in range(bucket_count)]
+    for word_index, deletes in enumerate(word_deletes):
+        for delete in deletes:
+            buckets[_bucket(delete, bucket_count)].add(word_index)
+
+    encoded_words = [word.encode("utf-8") for word in words]
+    word_ends, end = [], 0
+    for encoded_word in encoded_words:
+        end += len(encoded_word)
+        word_ends.append(end)
+    bucket_starts, candidates = [0], []
+    for bucket in buckets:
+        candidates.extend(sorted(bucket))
+        bucket_starts.append(len(candidates))
+
+    sections = [b"".join(encoded_words), _uint32_bytes(word_ends), _uint32_bytes(word_counts[word] for word in words),
+                _uint32_bytes(bucket_starts), _uint32_bytes(candidates)]
+    data = bytearray(SPELL_HEADER.size)
+    offsets = []
+    for section in sections:
+        data += b"\0" * (-len(data) % 4) # Keep sections aligned for memoryview.cast()
+        offsets += [len(data), len(section)]
+        data += section
+    SPELL_HEADER.pack_into(data, 0, SPELL_MAGIC, SPELL_VERSION, len(words), bucket_count, *offsets)
+    return bytes(data)
+
+
+def write_spelling_data(word_counts, filepath):
+    with open(filepath, 'wb') as outfile:
+        outfile.write(build_spelling_data(word_counts))
+
+
+class _Words(Sequence):
+    """Sorted words of a deletion dictionary, decoded on access (so bisect can search them)."""
+
+    def __init__(self, text, ends):
+        self._text = text
+        self._ends = ends
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, word_index):
+        if not 0 <= word_index < len(self._ends):
+            raise IndexError(word_index)
+        return str(self._text[self._ends[word_index - 1] if word_index else 0:self._ends[word_index]], "utf-8")
+
+
+class SpellCorrector:
+    """Corrects words against one vocabulary using a binary deletion dictionary, in memory or memory-mapped."""
+
+    def __init__(self, spelling_data):
+        view = memoryview(spelling_data)
+        magic, version, _, self._bucket_count, *offsets = SPELL_HEADER.unpack_from(view)
+        if magic != SPELL_MAGIC or version != SPELL_VERSION:
+            raise ValueError(f"Not a version {SPELL_VERSION} spelling dictionary")
+        words, word_ends, counts, buckets, candidates = (view[offset:offset + length] for offset, length in zip(offsets[::2], offsets[1::2]))
+        word_ends, self._counts, self._buckets, self._candidates = (self._uint32_view(section) for section in (word_ends, counts, buckets, candidates))
+        self.words = _Words(words, word_ends)
+
+    @staticmethod
+    def _uint32_view(section):
+        values = section.cast("I")
+        if sys.byteorder != "little":
+            values = array("I", values.tobytes())
+            values.byteswap()
+        return values
+
+    @classmethod
+    def load(cls, filepath):
+        with open(filepath, "rb") as infile:
+            return cls(mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def word_index(self, word):
+        """Returns the number of `word` in the sorted words, or None if it is not a correctable vocabulary word."""
+        word_index = bisect_left(self.words, word)
+        return word_index if word_index < len(self.words) and self.words[word_index] == word else None
+
+    def suggest(self, word):
+        """Returns (correction, distance, count) for the closest, then most frequent, vocabulary word, or None."""
+        word_index = self.word_index(word)
+        if word_index is not None:
+            return word, 0, self._counts[word_index]
+        best = None
+        seen = set()
+        for delete in _deletes(word):
+            bucket = _bucket(delete, self._bucket_count)
+            for word_index in self._candidates[self._buckets[bucket]:self._buckets[bucket + 1]]:
+                if word_index in seen:
+                    continue
+                seen.add(word_index)
+                distance = edit_distance(word, self.words[word_index])
+                if distance > MAX_EDIT_DISTANCE:
+                    continue
+                candidate = (self.words[word_index], distance, self._counts[word_index])
+                if best is None or (distance, -candidate[2]) < (best[1], -best[2]):
+                    best = candidate
+        return best
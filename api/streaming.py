@@ -0,0 +1,145 @@
+# api/streaming.py
+"""
+Delivery of streamed Gemini answers to a chat.
+
+    reply = start_reply(chat_id, on_message=...)
+    for chunk_text in response_stream:
+        reply.append(chunk_text)
+    reply.finish("\n\nfooter")
+
+With STREAM_MODE "edit", EditingReply queues a placeholder at once and edits of
+it at most every STREAM_EDIT_INTERVAL seconds, so the user sees the first words
+early and a long answer costs one sendMessage per STREAM_MESSAGE_CHARS instead
+of one per fragment. Past that length the message is completed and the answer
+continues in a new one. Placeholder and edits go through the outbox like every
+other message (see dispatcher.py), so they keep their place behind earlier
+messages, respect the per-chat and global rate limits, and never make the
+handler wait; an edit still queued when a newer one arrives is skipped. With "chunks",
+ChunkedReply queues a new message whenever enough text or time has built up
+(the previous behaviour). on_message(text) is called with the source text of
+every completed message, e.g. to mirror it to the admin.
+
+Both convert the answer with one MarkdownV2Stream, so markup that spans
+chunks or messages stays intact and nothing is escaped twice.
+"""
+import time
+
+from .config import STREAM_MODE, STREAM_EDIT_INTERVAL, STREAM_MESSAGE_CHARS
+from .dispatcher import TELEGRAM_MAX_MESSAGE_CHARS, queue_message, queue_placeholder, queue_edit
+from .markdown_v2 import MarkdownV2Stream
+
+PLACEHOLDER_TEXT = "…"
+
+
+class ChunkedReply:
+    """Queues the answer as separate messages of up to max_chars, or whatever arrived within `interval` seconds."""
+
+    def __init__(self, chat_id, on_message=None, max_chars=3500, interval=3):
+        self.chat_id = chat_id
+        self.on_message = on_message
+        self.max_chars = max_chars
+        self.interval = interval
+        self.full_text = ""
+        self.source = "" # The answer and any suffix
+        self.sent_source = 0 # Source characters already queued
+        self.formatter = MarkdownV2Stream()
+        self.last_flush = time.time()
+
+    def _flush(self, limit=None):
+        message, source_end = self.formatter.cut(limit)
+        source_text = self.source[self.sent_source:source_end]
+        self.sent_source = source_end
+        if source_text.strip():
+            queue_message(self.chat_id, message, join="", formatted=True)
+            if self.on_message:
+                self.on_message(source_text)
+        self.last_flush = time.time()
+
+    def _add(self, text):
+        self.source += text
+        self.formatter.feed(text)
+        while self.formatter.total_length > TELEGRAM_MAX_MESSAGE_CHARS:
+            self._flush(TELEGRAM_MAX_MESSAGE_CHARS)
+
+    def append(self, text):
+        self.full_text += text
+        self._add(text)
+        if self.formatter.total_length >= self.max_chars or (not self.formatter.empty and time.time() - self.last_flush >= self.interval):
+            self._flush()
+
+    def finish(self, suffix=""):
+        """Sends what is left (followed by suffix); returns the whole answer without the suffix."""
+        self._add(suffix)
+        self.formatter.finish()
+        self._add("") # Resolving the held-back characters may have pushed it over the limit
+        self._flush()
+        return self.full_text
+
+
+class EditingReply:
+    """Shows the answer in one message that is edited as it grows, continued in a new message at STREAM_MESSAGE_CHARS."""
+
+    def __init__(self, chat_id, on_message=None):
+        self.chat_id = chat_id
+        self.on_message = on_message
+        self.full_text = ""
+        self.source = "" # The answer and any suffix
+        self.message_source = 0 # Where the current message starts in source
+        self.formatter = MarkdownV2Stream()
+        self.shown = "" # What the current message shows once the queued edits are sent
+        self.next_edit = 0.0
+        self.handle = self._start_message()
+
+    def _start_message(self):
+        """Queues a new message for the answer to continue in; returns its outbox handle."""
+        self.shown = PLACEHOLDER_TEXT
+        self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        return queue_placeholder(self.chat_id, PLACEHOLDER_TEXT)
+
+    def _edit(self, message, source_text, final=False):
+        """Queues an edit showing message (MarkdownV2) in the current message; source_text is its plain-text fallback."""
+        if not source_text.strip() or (message == self.shown and not final):
+            return
+        if self.handle is None: # The previous message is complete: this text starts the next one
+            self.handle = self._start_message()
+        queue_edit(self.chat_id, self.handle, message, source_text, final)
+        self.shown = message
+        self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+
+    def _complete(self, limit=None):
+        """Completes the current message with the text so far, or with as much as fits in limit."""
+        message, source_end = self.formatter.cut(limit)
+        source_text = self.source[self.message_source:source_end]
+        self.message_source = source_end
+        self._edit(message, source_text, final=True)
+        if self.on_message and source_text.strip():
+            self.on_message(source_text)
+        self.handle = None # The next edit starts a new message
+        self.shown = ""
+
+    def _add(self, text):
+        self.source += text
+        self.formatter.feed(text)
+        while self.formatter.total_length > STREAM_MESSAGE_CHARS:
+            self._complete(STREAM_MESSAGE_CHARS)
+
+    def append(self, text):
+        self.full_text += text
+        self._add(text)
+        if time.monotonic() >= self.next_edit:
+            self._edit(self.formatter.render(), self.source[self.message_source:self.formatter.source_position])
+
+    def finish(self, suffix=""):
+        """Shows the rest of the answer (followed by suffix); returns the whole answer without the suffix."""
+        self._add(suffix)
+        self.formatter.finish()
+        self._add("") # Resolving the held-back characters may have pushed it over the limit
+        self._complete()
+        return self.full_text
+
+
+def start_reply(chat_id, on_message=None, max_chars=3500, interval=3):
+    """Returns the reply object for STREAM_MODE; max_chars and interval only apply to "chunks"."""
+    if STREAM_MODE == "edit":
+        return EditingReply(chat_id, on_message)
+    return ChunkedReply(chat_id, on_message, max_chars, interval)
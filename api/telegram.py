@@ -1,24 +1,37 @@
 from typing import Dict
 
-import requests
 from md2tgmd import escape
 
 from .config import BOT_TOKEN
+from .http_session import TELEGRAM_SESSION, TELEGRAM_TIMEOUT
+from .image_pipeline import select_photo_size
 
 TELEGRAM_API = f"https://api.telegram.org/bot{BOT_TOKEN}"
 
-def send_message(chat_id, text, **kwargs):
-    """send text message"""
+def send_message(chat_id, text, formatted=False, **kwargs):
+    """send text message; formatted=True means text is MarkdownV2 already"""
     payload = {
         "chat_id": chat_id,
-        "text": escape(text),
+        "text": text if formatted else escape(text),
         "parse_mode": "MarkdownV2",
         **kwargs,
     }
-    r = requests.post(f"{TELEGRAM_API}/sendMessage", data=payload)
+    r = TELEGRAM_SESSION.post(f"{TELEGRAM_API}/sendMessage", data=payload, timeout=TELEGRAM_TIMEOUT)
     print(f"Sent message: {text} to {chat_id}")
     return r
 
+def edit_message_text(chat_id, message_id, text, parse_mode="MarkdownV2", formatted=False):
+    """replace the text of a sent message; parse_mode=None sends it as plain text"""
+    payload = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": escape(text) if parse_mode == "MarkdownV2" and not formatted else text,
+    }
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    r = TELEGRAM_SESSION.post(f"{TELEGRAM_API}/editMessageText", data=payload, timeout=TELEGRAM_TIMEOUT)
+    return r
+
 def send_imageMessage(chat_id, text, imageID):
     """send image message"""
     payload = {
@@ -27,7 +40,7 @@ def send_imageMessage(chat_id, text, imageID):
         "parse_mode": "MarkdownV2",
         "photo": imageID
     }
-    r = requests.post(f"{TELEGRAM_API}/sendPhoto", data=payload)
+    r = TELEGRAM_SESSION.post(f"{TELEGRAM_API}/sendPhoto", data=payload, timeout=TELEGRAM_TIMEOUT)
     print(f"Sent imageMessage: {text} to {chat_id}")
     return r
 
@@ -40,7 +53,7 @@ def send_message_with_inline_keyboard(chat_id, text, keyboard, **kwargs):
         "reply_markup": {"inline_keyboard": keyboard},
         **kwargs,
     }
-    r = requests.post(f"{TELEGRAM_API}/sendMessage", json=payload)
+    r = TELEGRAM_SESSION.post(f"{TELEGRAM_API}/sendMessage", json=payload, timeout=TELEGRAM_TIMEOUT)
     print(f"Sent message with keyboard: {text} to {chat_id}")
     return r
 
@@ -51,7 +64,7 @@ def forward_message(chat_id, from_chat_id, message_id):
         "from_chat_id": from_chat_id,
         "message_id": message_id,
     }
-    r = requests.post(f"{TELEGRAM_API}/forwardMessage", json=payload)
+    r = TELEGRAM_SESSION.post(f"{TELEGRAM_API}/forwardMessage", json=payload, timeout=TELEGRAM_TIMEOUT)
     return r
 
 def copy_message(chat_id, from_chat_id, message_id):
@@ -62,7 +75,7 @@ def copy_message(chat_id, from_chat_id, message_id):
         "chat_id": from_chat_id,
         "message_id": message_id
     }
-    message_details = requests.post(get_message_url, json=message_payload).json()
+    message_details = TELEGRAM_SESSION.post(get_message_url, json=message_payload, timeout=TELEGRAM_TIMEOUT).json()
     
     if not message_details['ok']:
         print(f"Failed to retrieve message: {message_details['description']}")
@@ -88,6 +101,7 @@ class Update:
         self.text = self._text()
         self.photo_caption = self._photo_caption()
         self.file_id = self._file_id()
+        self.vision_file_id, self.vision_file_unique_id = self._vision_file_id()
         self.user_name = update["message"]["from"].get("username", f" [UnnamedUser](tg://openmessage?user_id={self.from_id})")
         self.message_id: int = update["message"]["message_id"]
 
@@ -120,3 +134,10 @@ class Update:
         if self.type == "photo":
             return self.update["message"]["photo"][-1]["file_id"]
         return ""
+
+    def _vision_file_id(self):
+        """The smallest photo size that is still large enough for the vision model"""
+        if self.type == "photo":
+            photo_size = select_photo_size(self.update["message"]["photo"])
+            return photo_size["file_id"], photo_size.get("file_unique_id")
+        return "", None
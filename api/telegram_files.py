@@ -0,0 +1,91 @@
+# api/telegram_files.py
+"""
+Cached access to files sent to the bot.
+
+getFile results (file_id -> file_path) are kept for FILE_PATH_TTL seconds;
+Telegram guarantees a download link for at least an hour. Downloaded bytes
+are kept by file_unique_id, which stays the same when a photo is forwarded or
+sent again, in a cache bounded by FILE_CACHE_MAX_MB and FILE_CACHE_TTL.
+Downloads are streamed and abandoned past FILE_MAX_DOWNLOAD_MB instead of
+reading the whole response into memory first.
+"""
+import threading
+from io import BytesIO
+
+from cachetools import TTLCache
+
+from .config import BOT_TOKEN, FILE_CACHE_MAX_MB, FILE_CACHE_TTL, FILE_MAX_DOWNLOAD_MB
+from .http_session import TELEGRAM_SESSION, TELEGRAM_TIMEOUT
+
+FILE_PATH_TTL = 3000 # Seconds; under the one hour a getFile link is valid for
+FILE_PATH_CACHE_SIZE = 1024
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+DOWNLOAD_TIMEOUT = (5, 30) # Connect timeout, and seconds allowed between two received chunks
+
+FILE_PATH_CACHE = TTLCache(maxsize=FILE_PATH_CACHE_SIZE, ttl=FILE_PATH_TTL) # file_id -> file_path
+FILE_BYTES_CACHE = TTLCache(maxsize=int(FILE_CACHE_MAX_MB * 1024 * 1024), ttl=FILE_CACHE_TTL, getsizeof=len) # file_unique_id -> bytes
+FILE_CACHE_LOCK = threading.Lock() # Guards both caches and FILE_CACHE_STATS
+FILE_CACHE_STATS = {"path_hits": 0, "path_misses": 0, "download_hits": 0, "download_misses": 0}
+
+
+class FileTooLargeError(ValueError):
+    """Raised when a file is larger than FILE_MAX_DOWNLOAD_MB."""
+
+
+def get_file_path(file_id):
+    """Returns the file_path of a file_id from getFile, asking Telegram only when it is not cached."""
+    with FILE_CACHE_LOCK:
+        file_path = FILE_PATH_CACHE.get(file_id)
+        FILE_CACHE_STATS["path_hits" if file_path else "path_misses"] += 1
+    if file_path:
+        return file_path
+    response = TELEGRAM_SESSION.get(f"https://api.telegram.org/bot{BOT_TOKEN}/getFile", params={"file_id": file_id}, timeout=TELEGRAM_TIMEOUT)
+    result = response.json()
+    if not result.get("ok"):
+        raise RuntimeError(f"getFile failed: {result.get('description')}")
+    file_path = result["result"]["file_path"]
+    with FILE_CACHE_LOCK:
+        FILE_PATH_CACHE[file_id] = file_path
+    return file_path
+
+
+def file_url(file_id):
+    return f"https://api.telegram.org/file/bot{BOT_TOKEN}/{get_file_path(file_id)}"
+
+
+def _download(url, max_bytes):
+    """Streams url into memory, stopping as soon as it is known to be larger than max_bytes."""
+    with TELEGRAM_SESSION.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        if int(response.headers.get("Content-Length") or 0) > max_bytes:
+            raise FileTooLargeError(f"File is {int(response.headers['Content-Length']) // 1024} KB, the limit is {max_bytes // 1024} KB.")
+        data = bytearray()
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+            data.extend(chunk)
+            if len(data) > max_bytes:
+                raise FileTooLargeError(f"File is over the limit of {max_bytes // 1024} KB.")
+    return bytes(data)
+
+
+def download_file(file_id, file_unique_id=None) -> BytesIO:
+    """Returns the bytes of a file; with file_unique_id, repeated and forwarded files are served from the cache."""
+    if file_unique_id:
+        with FILE_CACHE_LOCK:
+            data = FILE_BYTES_CACHE.get(file_unique_id)
+            FILE_CACHE_STATS["download_hits" if data is not None else "download_misses"] += 1
+        if data is not None:
+            return BytesIO(data)
+    data = _download(file_url(file_id), int(FILE_MAX_DOWNLOAD_MB * 1024 * 1024))
+    if file_unique_id:
+        with FILE_CACHE_LOCK:
+            try:
+                FILE_BYTES_CACHE[file_unique_id] = data
+            except ValueError: # Larger than the whole cache
+                pass
+    return BytesIO(data)
+
+
+def file_cache_stats():
+    with FILE_CACHE_LOCK:
+        return {**FILE_CACHE_STATS, "paths": len(FILE_PATH_CACHE), "files": len(FILE_BYTES_CACHE),
+                "size_mb": round(FILE_BYTES_CACHE.currsize / (1024 * 1024), 2), "max_mb": FILE_CACHE_MAX_MB}
@@ -77,20 +77,71 @@ def search_concept_pages(textbook_id, concept): # Helper function to find pages
 # api/textbook_processor.py
 import json
 import os
+import threading
+
+from cachetools import LRUCache, TTLCache
+
+from .config import SEARCH_TOP_K, SEARCH_MODE, CONTEXT_MAX_CHARS, CONTEXT_WINDOW_CHARS, ROUTE_MAX_BOOKS, ROUTE_MIN_SCORE_RATIO, \
+    TEXTBOOK_CACHE_MAX_MB, TEXTBOOK_PRELOAD, RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL, SPELLING_CACHE_SIZE
+from .search_index import TextbookIndex, MappedTextbookIndex, GlobalIndex, tokenize
+from .spelling import SpellCorrector, build_spelling_data, is_correctable
+from .tfidf_index import TFIDF_AVAILABLE, TFIDF_FILENAME, TfidfIndex
 
 TEXTBOOK_INDEX_DIR = "api/textbook_index" # Directory where index files are stored
-TEXTBOOK_CACHE = {}  # Dictionary to cache loaded textbook indices in memory
+
+
+class TextbookCache(LRUCache):
+    """LRU cache of loaded textbook indexes, bounded by their estimated memory size; counts evictions."""
+
+    def __init__(self, max_bytes):
+        super().__init__(maxsize=max_bytes, getsizeof=lambda textbook_index: textbook_index.memory_size)
+        self.evictions = 0
+
+    def popitem(self):
+        textbook_id, textbook_index = super().popitem()
+        self.evictions += 1
+        print(f"Index for textbook '{textbook_id}' evicted from cache.") # Log eviction
+        return textbook_id, textbook_index
+
+    def clear(self):
+        """Drops every textbook; unlike popitem() when over budget, not counted as evictions."""
+        while self:
+            super().popitem()
+
+
+TEXTBOOK_CACHE = TextbookCache(int(TEXTBOOK_CACHE_MAX_MB * 1024 * 1024)) # Loaded textbook indexes, least recently used evicted first
+TEXTBOOK_CACHE_LOCK = threading.Lock() # Guards TEXTBOOK_CACHE and CACHE_STATS
+TEXTBOOK_LOAD_LOCKS = {} # textbook_id -> Lock held while that textbook loads, so concurrent requests load it once
+CACHE_STATS = {"hits": 0, "misses": 0}
+RETRIEVAL_CACHE = TTLCache(maxsize=RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL) # (textbook_id, concept, mode, index version) -> result
+RETRIEVAL_CACHE_LOCK = threading.Lock() # Guards RETRIEVAL_CACHE and RETRIEVAL_STATS
+RETRIEVAL_STATS = {"hits": 0, "misses": 0}
+TFIDF_CACHE = {} # Holds the loaded TF-IDF index under "index"
+TFIDF_CACHE_LOCK = threading.Lock() # Guards TFIDF_CACHE, so concurrent requests load it once
+SPELLING_CACHE = LRUCache(maxsize=SPELLING_CACHE_SIZE) # textbook_id -> SpellCorrector (None if unavailable)
+SPELLING_CACHE_LOCK = threading.Lock() # Guards SPELLING_CACHE
+SPELLING_LOAD_LOCKS = {} # textbook_id -> Lock held while that textbook's corrector loads
+SECTION_HEADER_CHARS = 160 # Budget kept for the "[Section ...]" line of a section context
 
 def load_textbook_index(textbook_id):
-    """Loads textbook index from JSON file and caches it."""
+    """Loads a textbook index (memory-mapped binary if present, JSON otherwise); returns None on failure."""
+    binary_filepath = os.path.join(TEXTBOOK_INDEX_DIR, f"{textbook_id}_index.bin")
+    if os.path.exists(binary_filepath):
+        try:
+            textbook_index = MappedTextbookIndex(textbook_id, binary_filepath)
+            print(f"Binary index for textbook '{textbook_id}' mapped from '{binary_filepath}'.") # Log loading success
+            return textbook_index
+        except Exception as e:
+            print(f"Error mapping binary index for '{textbook_id}' from '{binary_filepath}': {e}. Falling back to JSON.")
+
     index_filepath = os.path.join(TEXTBOOK_INDEX_DIR, f"{textbook_id}_index.json")
     print(f"Loading index for textbook '{textbook_id}' from '{index_filepath}'...") # Log loading start
     try:
         with open(index_filepath, 'r') as infile:
             index_data = json.load(infile)
-            TEXTBOOK_CACHE[textbook_id] = index_data # Cache index data
-            print(f"Index for textbook '{textbook_id}' loaded and cached successfully.") # Log loading success
-            return index_data
+        textbook_index = TextbookIndex(textbook_id, index_data["chunks"], index_data.get("postings"), index_data.get("sections")) # Builds postings/sections if missing
+        print(f"Index for textbook '{textbook_id}' loaded successfully.") # Log loading success
+        return textbook_index
     except FileNotFoundError:
         print(f"Error: Index file not found for textbook '{textbook_id}' at '{index_filepath}'") # Log file not found error
         return None
@@ -103,35 +154,293 @@ def load_textbook_index(textbook_id):
 
 
 def get_textbook_content(textbook_id):
-    """Returns textbook content (index data) from cache or loads it if not cached."""
-    if textbook_id in TEXTBOOK_CACHE:
-        print(f"Index for textbook '{textbook_id}' found in cache.") # Log cache hit
-        return TEXTBOOK_CACHE[textbook_id] # Return from cache
-    else:
-        print(f"Index for textbook '{textbook_id}' not in cache. Loading from file...") # Log cache miss
-        return load_textbook_index(textbook_id) # Load from file
+    """Returns textbook content (index data) from cache or loads it if not cached. Thread-safe."""
+    with TEXTBOOK_CACHE_LOCK:
+        textbook_index = TEXTBOOK_CACHE.get(textbook_id)
+        if textbook_index is not None:
+            CACHE_STATS["hits"] += 1
+            return textbook_index
+    if textbook_id not in available_textbooks(): # No load lock for IDs without an index file, so user input cannot grow the dict
+        print(f"Error: No index file for textbook '{textbook_id}' in '{TEXTBOOK_INDEX_DIR}'")
+        return None
+    with TEXTBOOK_CACHE_LOCK:
+        load_lock = TEXTBOOK_LOAD_LOCKS.setdefault(textbook_id, threading.Lock())
+
+    with load_lock:
+        with TEXTBOOK_CACHE_LOCK: # Another request may have loaded it while we waited
+            textbook_index = TEXTBOOK_CACHE.get(textbook_id)
+            if textbook_index is not None:
+                CACHE_STATS["hits"] += 1
+                return textbook_index
+            CACHE_STATS["misses"] += 1
+        textbook_index = load_textbook_index(textbook_id) # Load from file
+        if textbook_index is not None:
+            with TEXTBOOK_CACHE_LOCK:
+                try:
+                    TEXTBOOK_CACHE[textbook_id] = textbook_index
+                except ValueError: # Larger than the whole budget: serve it uncached
+                    print(f"Index for textbook '{textbook_id}' exceeds TEXTBOOK_CACHE_MAX_MB, not cached.")
+        return textbook_index
+
+
+def textbook_cache_stats():
+    """Returns hit/miss/eviction counters and the current size of the textbook cache."""
+    with TEXTBOOK_CACHE_LOCK:
+        return {**CACHE_STATS, "evictions": TEXTBOOK_CACHE.evictions, "textbooks": sorted(TEXTBOOK_CACHE),
+                "size_mb": round(TEXTBOOK_CACHE.currsize / (1024 * 1024), 1), "max_mb": TEXTBOOK_CACHE_MAX_MB}
+
+
+def index_version(textbook_ids):
+    """Returns a value that changes whenever the index file of one of the textbooks is rewritten."""
+    version = []
+    for textbook_id in textbook_ids:
+        for suffix in ("_index.bin", "_index.json"):
+            try:
+                version.append(os.stat(os.path.join(TEXTBOOK_INDEX_DIR, f"{textbook_id}{suffix}")).st_mtime_ns)
+            except OSError:
+                version.append(0)
+    return tuple(version)
+
+
+def cached_retrieval(textbook_id, concept, textbook_ids, retrieve):
+    """
+    Returns retrieve(textbook_id, concept), memoized (LRU + TTL) on the textbook, the normalized
+    concept, SEARCH_MODE and the index version of textbook_ids (the books the search reads), so
+    "Photosynthesis" and "photosynthesis " share an entry and a rebuilt index is never served stale.
+    """
+    key = (textbook_id, " ".join(tokenize(concept)), SEARCH_MODE, index_version(textbook_ids))
+    with RETRIEVAL_CACHE_LOCK:
+        result = RETRIEVAL_CACHE.get(key)
+        if result is not None:
+            RETRIEVAL_STATS["hits"] += 1
+            return result
+        RETRIEVAL_STATS["misses"] += 1
+    result = retrieve(textbook_id, concept)
+    with RETRIEVAL_CACHE_LOCK:
+        RETRIEVAL_CACHE[key] = result
+    return result
 
 
-def get_text_from_pages(textbook_id, page_numbers):
-    """Retrieves combined text from specified pages using the loaded index."""
+def retrieval_cache_stats():
+    """Returns hit/miss counters and the number of entries of the retrieval cache."""
+    with RETRIEVAL_CACHE_LOCK:
+        return {**RETRIEVAL_STATS, "entries": len(RETRIEVAL_CACHE), "max_entries": RETRIEVAL_CACHE.maxsize}
+
+
+def preload_textbooks(textbook_ids=TEXTBOOK_PRELOAD):
+    """Loads the given textbooks ("all" for every textbook) and their spelling correctors into the caches in a background thread."""
+    if not textbook_ids:
+        return None
+    if "all" in textbook_ids:
+        textbook_ids = available_textbooks()
+
+    def preload():
+        for textbook_id in textbook_ids:
+            get_textbook_content(textbook_id)
+            get_spell_corrector(textbook_id)
+        print(f"Preloaded textbooks: {', '.join(textbook_ids)}")
+
+    thread = threading.Thread(target=preload, name="textbook-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_text_from_pages(textbook_id, page_numbers, max_chars=None):
+    """Retrieves combined text from specified pages using the loaded index, optionally capped at max_chars."""
     textbook_index = get_textbook_content(textbook_id) # Get index data from cache or load
     if not textbook_index:
         return ""
-    combined_text = ""
-    for page_data in textbook_index["chunks"]: # Access 'chunks' from index data
-        if page_data["page_number"] in page_numbers:
-            combined_text += page_data["text"] + "\n\n"
-    return combined_text
+    page_texts = [textbook_index.page_text(page_number) for page_number in sorted(set(page_numbers))] # Direct page lookup
+    combined_text = "".join(f"{page_text}\n\n" for page_text in page_texts)
+    return combined_text[:max_chars] if max_chars else combined_text
+
+
+def get_table_of_contents(textbook_id):
+    """Returns the textbook's units and sections as [(section_id, title, start_page, end_page)], in book order."""
+    textbook_index = get_textbook_content(textbook_id) # Get index data from cache or load
+    if not textbook_index:
+        return []
+    return [(section["section_id"], section["title"], section["start_page"], section["end_page"])
+            for section in textbook_index.sections]
 
 
 def search_concept_pages(textbook_id, concept):
-    """Searches for a concept in the textbook index and returns page numbers."""
+    """Searches for a concept (phrase) in the textbook's inverted index and returns page numbers."""
     textbook_index = get_textbook_content(textbook_id) # Get index data from cache or load
     if not textbook_index:
         return []
+    return textbook_index.phrase_pages(concept) # Only pages holding the query terms are checked
 
-    concept_pages = []
-    for page_data in textbook_index["chunks"]: # Access 'chunks' from index data
-        if concept.lower() in page_data["text"].lower():
-            concept_pages.append(page_data["page_number"])
-    return concept_pages
+
+def load_spell_corrector(textbook_id):
+    """Maps the textbook's precomputed deletion dictionary, or builds it from the index vocabulary if missing; None on failure."""
+    spelling_filepath = os.path.join(TEXTBOOK_INDEX_DIR, f"{textbook_id}_spell.bin")
+    try:
+        if os.path.exists(spelling_filepath):
+            return SpellCorrector.load(spelling_filepath)
+        print(f"Spelling data not found at '{spelling_filepath}', building it (run preprocess_textbooks to avoid this)...")
+        textbook_index = get_textbook_content(textbook_id)
+        return SpellCorrector(build_spelling_data(textbook_index.document_frequencies())) if textbook_index else None
+    except Exception as e:
+        print(f"Error loading spelling data for textbook '{textbook_id}': {e}")
+        return None
+
+
+def get_spell_corrector(textbook_id):
+    """Returns the textbook's SpellCorrector from cache, loading it once even under concurrent requests. Thread-safe."""
+    with SPELLING_CACHE_LOCK:
+        if textbook_id in SPELLING_CACHE:
+            return SPELLING_CACHE[textbook_id]
+    if textbook_id not in available_textbooks(): # As in get_textbook_content: unknown IDs get no load lock
+        return None
+    with SPELLING_CACHE_LOCK:
+        load_lock = SPELLING_LOAD_LOCKS.setdefault(textbook_id, threading.Lock())
+
+    with load_lock:
+        with SPELLING_CACHE_LOCK: # Another request may have loaded it while we waited
+            if textbook_id in SPELLING_CACHE:
+                return SPELLING_CACHE[textbook_id]
+        corrector = load_spell_corrector(textbook_id)
+        with SPELLING_CACHE_LOCK:
+            SPELLING_CACHE[textbook_id] = corrector
+        return corrector
+
+
+def correct_concept(concept, textbook_ids):
+    """
+    Replaces words of `concept` missing from every given textbook's vocabulary with their
+    closest (then most frequent) vocabulary word. Returns the concept unchanged if nothing was corrected.
+    """
+    tokens = tokenize(concept)
+    textbook_indexes = [textbook_index for textbook_index in map(get_textbook_content, textbook_ids) if textbook_index]
+    unknown_tokens = {token for token in tokens
+                      if is_correctable(token) and not any(textbook_index.has_token(token) for textbook_index in textbook_indexes)}
+    if not unknown_tokens:
+        return concept # Correctors are only loaded when some word is found in none of the textbooks
+
+    correctors = [corrector for corrector in map(get_spell_corrector, textbook_ids) if corrector]
+    corrected_tokens = []
+    for token in tokens:
+        if token not in unknown_tokens:
+            corrected_tokens.append(token)
+            continue
+        suggestions = [suggestion for suggestion in (corrector.suggest(token) for corrector in correctors) if suggestion]
+        best = min(suggestions, key=lambda suggestion: (suggestion[1], -suggestion[2]), default=None)
+        corrected_tokens.append(best[0] if best else token)
+    return " ".join(corrected_tokens) if corrected_tokens != tokens else concept
+
+
+def get_tfidf_index():
+    """
+    Returns the TF-IDF index, loading it on first use. Thread-safe.
+    Returns None (callers fall back to BM25) if numpy or the prebuilt tfidf.npz is missing; it is never built on a request.
+    """
+    if not TFIDF_AVAILABLE:
+        return None
+    with TFIDF_CACHE_LOCK:
+        if "index" not in TFIDF_CACHE:
+            tfidf_filepath = os.path.join(TEXTBOOK_INDEX_DIR, TFIDF_FILENAME)
+            try:
+                TFIDF_CACHE["index"] = TfidfIndex(tfidf_filepath)
+            except FileNotFoundError:
+                print(f"TF-IDF index not found at '{tfidf_filepath}', using BM25 (build it with preprocess_textbooks --tfidf).")
+                TFIDF_CACHE["index"] = None
+            except Exception as e:
+                print(f"Error loading TF-IDF index: {e}")
+                TFIDF_CACHE["index"] = None
+        return TFIDF_CACHE["index"]
+
+
+def rank_concept_pages(textbook_id, concept, top_k=SEARCH_TOP_K, mode=SEARCH_MODE):
+    """
+    Ranks textbook pages for a concept and returns the top_k as [(page_number, score)], best first.
+    mode is "bm25" (inverted index) or "tfidf" (character n-grams; falls back to BM25 when unavailable).
+    """
+    if mode == "tfidf":
+        tfidf_index = get_tfidf_index()
+        if tfidf_index:
+            return [(page_number, score) for _, page_number, score in tfidf_index.rank_pages(concept, top_k, textbook_id)]
+
+    textbook_index = get_textbook_content(textbook_id) # Get index data from cache or load
+    if not textbook_index:
+        return []
+    return textbook_index.rank_pages(concept, top_k)
+
+
+def available_textbooks():
+    """Returns the IDs of all textbooks with an index file in TEXTBOOK_INDEX_DIR."""
+    textbook_ids = set()
+    for filename in os.listdir(TEXTBOOK_INDEX_DIR):
+        for suffix in ("_index.json", "_index.bin"):
+            if filename.endswith(suffix):
+                textbook_ids.add(filename[:-len(suffix)])
+    return sorted(textbook_ids)
+
+
+def route_concept(concept, top_k=SEARCH_TOP_K, max_books=ROUTE_MAX_BOOKS, min_score_ratio=ROUTE_MIN_SCORE_RATIO):
+    """
+    Scores a concept against every textbook at once and picks the book(s) to answer from.
+
+    Returns [(textbook_id, [(page_number, score), ...]), ...], best book first. A
+    further book is included when its share of the top pages scores at least
+    min_score_ratio of the best book's. Returns [] when no page covers the concept.
+    """
+    textbook_indexes = [get_textbook_content(textbook_id) for textbook_id in available_textbooks()]
+    global_index = GlobalIndex([textbook_index for textbook_index in textbook_indexes if textbook_index])
+
+    book_pages = {}
+    for textbook_id, page_number, score in global_index.rank_pages(concept, top_k):
+        book_pages.setdefault(textbook_id, []).append((page_number, score))
+    if not book_pages:
+        return []
+
+    book_scores = {textbook_id: sum(score for _, score in pages) for textbook_id, pages in book_pages.items()}
+    ranked_books = sorted(book_scores, key=book_scores.get, reverse=True)
+    best_score = book_scores[ranked_books[0]]
+    return [(textbook_id, book_pages[textbook_id]) for textbook_id in ranked_books[:max_books]
+            if book_scores[textbook_id] >= min_score_ratio * best_score]
+
+
+def build_context(textbook_id, concept, ranked_pages, max_chars=CONTEXT_MAX_CHARS, window_chars=CONTEXT_WINDOW_CHARS):
+    """
+    Packs the best-scoring passages into a context of at most max_chars (about max_chars / 4 tokens).
+
+    When the smallest unit/section around the best page mentions every concept
+    term and fits the budget, that whole section is the context. Otherwise pages
+    are taken in ranked order and trimmed to windows around the matched concept
+    terms. Returns (context_text, used_pages, dropped_pages); a page is dropped
+    when none of its passages fit the remaining budget, or when it lies outside
+    the section used.
+    """
+    textbook_index = get_textbook_content(textbook_id) # Get index data from cache or load
+    if not textbook_index:
+        return "", [], [page_number for page_number, _ in ranked_pages]
+
+    concept_section = textbook_index.concept_section(concept, ranked_pages[0][0], max_chars - SECTION_HEADER_CHARS) if ranked_pages else None
+    if concept_section:
+        section, section_text = concept_section
+        header = f"[Section {section['section_id']} {section['title']}, pages {section['start_page']}-{section['end_page']}]\n"
+        dropped_pages = [page_number for page_number, _ in ranked_pages if not section["start_page"] <= page_number <= section["end_page"]]
+        return header + section_text, list(range(section["start_page"], section["end_page"] + 1)), dropped_pages
+
+    parts = []
+    used_pages = []
+    dropped_pages = []
+    remaining = max_chars
+    for page_number, _ in ranked_pages:
+        header = f"[Page {page_number}]\n"
+        page_passages = []
+        # Pages ranked on partial matches (tfidf mode) may hold no exact term; use their opening instead
+        page_head = textbook_index.page_text(page_number)[:2 * window_chars].strip()
+        for passage in textbook_index.passages(page_number, concept, window_chars) or ([page_head] if page_head else []):
+            cost = len(passage) + len(header) + 2 if not page_passages else len(passage) + 5
+            if cost > remaining:
+                break
+            page_passages.append(passage)
+            remaining -= cost
+        if page_passages:
+            parts.append(header + "\n...\n".join(page_passages))
+            used_pages.append(page_number)
+        else:
+            dropped_pages.append(page_number)
+    return "\n\n".join(parts), used_pages, dropped_pages
@@ -0,0 +1,131 @@
+# api/tfidf_index.py
+"""
+Character n-gram TF-IDF index over every page of every textbook.
+
+Pages are vectorized with hashed character n-grams taken inside word
+boundaries (" photo", "hoto", ...), so a query still scores pages that only
+share parts of its words ("mitocondria" vs. "mitochondria") or use another
+inflection. The matrix is stored column-major (one column per hashed n-gram)
+in `tfidf.npz` next to the JSON indexes; scoring a query gathers only the
+columns of its own n-grams and sums them per page in one vectorized pass.
+
+Requires NumPy; when it is not installed TFIDF_AVAILABLE is False and the
+"tfidf" search mode falls back to BM25, as it does when `tfidf.npz` was not
+built by preprocess_textbooks.py. NumPy is imported on first use only,
+as it is slow to import and most cold starts never need it.
+"""
+import importlib.util
+import zlib
+from collections import Counter
+
+from .search_index import TOKEN_PATTERN
+
+TFIDF_AVAILABLE = importlib.util.find_spec("numpy") is not None # Optional dependency
+np = None # numpy, once _import_numpy() ran
+
+TFIDF_FILENAME = "tfidf.npz"
+NGRAM_SIZES = (3, 4, 5)
+HASH_BITS = 18 # 262144 n-gram buckets
+
+
+def _import_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+def _ngram_counts(text):
+    """Counts hashed character n-grams of each word padded with spaces."""
+    counts = Counter()
+    for word in TOKEN_PATTERN.findall(text.lower()):
+        padded = f" {word} "
+        for size in NGRAM_SIZES:
+            for start in range(len(padded) - size + 1):
+                counts[zlib.crc32(padded[start:start + size].encode("utf-8")) >> (32 - HASH_BITS)] += 1
+    return counts
+
+
+def _weights(counts, idf):
+    """Sublinear tf * idf weights, L2-normalized: returns (buckets, weights) arrays."""
+    buckets = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    weights = (1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))) * idf[buckets]
+    norm = np.linalg.norm(weights)
+    return buckets, (weights / norm if norm else weights).astype(np.float32)
+
+
+def build_tfidf_index(books, filepath):
+    """
+    Builds and saves the TF-IDF matrix for `books`, a list of (textbook_id, chunks).
+    Returns the loaded TfidfIndex.
+    """
+    _import_numpy()
+    row_books, row_pages, row_counts = [], [], []
+    book_ids = [textbook_id for textbook_id, _ in books]
+    for book_number, (_, chunks) in enumerate(books):
+        for page_data in chunks:
+            row_books.append(book_number)
+            row_pages.append(page_data["page_number"])
+            row_counts.append(_ngram_counts(page_data.get("search_text") or page_data["text"]))
+
+    bucket_count = 1 << HASH_BITS
+    document_frequency = np.zeros(bucket_count, dtype=np.int64)
+    for counts in row_counts:
+        document_frequency[np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))] += 1
+    idf = (np.log((1 + len(row_counts)) / (1 + document_frequency)) + 1).astype(np.float32)
+
+    # Assemble as (bucket, row, weight) triplets, then sort by bucket into column-major (CSC) order
+    buckets, rows, weights = [], [], []
+    for row, counts in enumerate(row_counts):
+        row_buckets, row_weights = _weights(counts, idf)
+        buckets.append(row_buckets)
+        rows.append(np.full(len(row_buckets), row, dtype=np.uint16))
+        weights.append(row_weights)
+    buckets, rows, weights = np.concatenate(buckets), np.concatenate(rows), np.concatenate(weights)
+    order = np.argsort(buckets, kind="stable")
+    indptr = np.zeros(bucket_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(buckets, minlength=bucket_count), out=indptr[1:])
+
+    np.savez_compressed(filepath, indptr=indptr, rows=rows[order], weights=weights[order], idf=idf,
+                        row_books=np.array(row_books, dtype=np.uint16), row_pages=np.array(row_pages, dtype=np.uint16),
+                        book_ids=np.array(book_ids))
+    return TfidfIndex(filepath)
+
+
+class TfidfIndex:
+    """Loaded TF-IDF matrix; rank_pages scores a query against all pages at once."""
+
+    def __init__(self, filepath):
+        _import_numpy()
+        with np.load(filepath) as arrays:
+            self.indptr = arrays["indptr"]
+            self.rows = arrays["rows"]
+            self.weights = arrays["weights"]
+            self.idf = arrays["idf"]
+            self.row_books = arrays["row_books"]
+            self.row_pages = arrays["row_pages"]
+            self.book_ids = [str(book_id) for book_id in arrays["book_ids"]]
+
+    def rank_pages(self, query, top_k=5, textbook_id=None):
+        """Returns the top_k [(textbook_id, page_number, score)] by cosine similarity, best first."""
+        counts = _ngram_counts(query)
+        if not counts:
+            return []
+        buckets, query_weights = _weights(counts, self.idf)
+
+        # Gather the matrix entries of the query's columns without a Python loop over them
+        starts, ends = self.indptr[buckets], self.indptr[buckets + 1]
+        lengths = ends - starts
+        if not lengths.sum():
+            return []
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        scores = np.bincount(self.rows[offsets], weights=self.weights[offsets] * np.repeat(query_weights, lengths),
+                             minlength=len(self.row_pages))
+
+        if textbook_id is not None:
+            if textbook_id not in self.book_ids:
+                return []
+            scores[self.row_books != self.book_ids.index(textbook_id)] = 0
+        best_rows = np.argsort(scores)[::-1][:top_k]
+        return [(self.book_ids[self.row_books[row]], int(self.row_pages[row]), float(scores[row]))
+                for row in best_rows if scores[row] > 0]
@@ -0,0 +1,150 @@
+# api/update_queue.py
+"""
+Background processing of webhook updates.
+
+With WEBHOOK_ASYNC=1 the webhook only checks an update, hands it to
+UPDATE_QUEUE and answers 200 at once, so a long Gemini answer no longer runs
+past Telegram's webhook timeout (which makes Telegram deliver the update
+again). WEBHOOK_WORKERS threads handle the updates. Each chat is always
+handled by the same worker, so one user's messages are answered in order
+and never concurrently. The queues are bounded by WEBHOOK_QUEUE_SIZE in
+total; when full, the webhook answers 503 and Telegram retries later.
+
+Update ids seen recently are remembered in both modes, so a redelivered update
+is answered only once. shutdown() (also run at exit) stops accepting updates
+and drains the queues and the outbox within WEBHOOK_DRAIN_TIMEOUT seconds.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from cachetools import TTLCache
+
+from .config import WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_DRAIN_TIMEOUT
+from .dispatcher import DISPATCHER
+
+SEEN_UPDATES_SIZE = 10000
+SEEN_UPDATES_TTL = 3600 # Seconds; Telegram stops redelivering long before this
+
+SEEN_UPDATES = TTLCache(maxsize=SEEN_UPDATES_SIZE, ttl=SEEN_UPDATES_TTL) # update_id -> True
+SEEN_UPDATES_LOCK = threading.Lock()
+
+
+def is_duplicate_update(update):
+    """True if this update_id was seen before; remembers it otherwise."""
+    with SEEN_UPDATES_LOCK:
+        if update["update_id"] in SEEN_UPDATES:
+            return True
+        SEEN_UPDATES[update["update_id"]] = True
+        return False
+
+
+def forget_update(update):
+    """Lets a later delivery of an update that failed be handled again."""
+    with SEEN_UPDATES_LOCK:
+        SEEN_UPDATES.pop(update["update_id"], None)
+
+
+def update_chat_id(update):
+    return update.get("message", {}).get("chat", {}).get("id") or update.get("message", {}).get("from", {}).get("id")
+
+
+class UpdateWorkerPool:
+    def __init__(self, handler, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        self.handler = handler
+        self.workers = workers
+        self.queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self.threads = []
+        self.accepting = True
+        self._lock = threading.Lock()
+        self.stats_counters = {"accepted": 0, "rejected": 0, "processed": 0, "failed": 0, "max_depth": 0,
+                               "in_flight": 0, "wait_ms_total": 0.0, "handle_ms_total": 0.0}
+
+    def _start(self):
+        """Starts the worker threads on first use (called with the lock held)."""
+        if self.threads:
+            return
+        for number, worker_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(worker_queue,), name=f"update-worker-{number}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, update):
+        """Queues an update; returns False if the pool is full or shutting down."""
+        worker_queue = self.queues[hash(update_chat_id(update)) % self.workers]
+        with self._lock:
+            if not self.accepting:
+                return False
+            self._start()
+            try:
+                worker_queue.put_nowait((time.monotonic(), update))
+            except queue.Full:
+                self.stats_counters["rejected"] += 1
+                return False
+            self.stats_counters["accepted"] += 1
+            self.stats_counters["max_depth"] = max(self.stats_counters["max_depth"], self.depth())
+        return True
+
+    def _run(self, worker_queue):
+        while True:
+            queued_at, update = worker_queue.get()
+            started = time.monotonic()
+            with self._lock:
+                self.stats_counters["in_flight"] += 1
+                self.stats_counters["wait_ms_total"] += (started - queued_at) * 1000
+            failed = False
+            try:
+                self.handler(update)
+            except Exception as e:
+                failed = True
+                logging.error("Error handling update %s: %s", update.get("update_id"), e)
+            finally:
+                with self._lock:
+                    self.stats_counters["in_flight"] -= 1
+                    self.stats_counters["failed" if failed else "processed"] += 1
+                    self.stats_counters["handle_ms_total"] += (time.monotonic() - started) * 1000
+                worker_queue.task_done()
+
+    def depth(self):
+        return sum(worker_queue.qsize() for worker_queue in self.queues)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.stats_counters)
+        done = counters["processed"] + counters["failed"]
+        return {
+            "depth": self.depth(),
+            "capacity": sum(worker_queue.maxsize for worker_queue in self.queues),
+            "workers": self.workers,
+            "accepting": self.accepting,
+            **{name: value for name, value in counters.items() if not name.endswith("_total")},
+            "avg_wait_ms": round(counters["wait_ms_total"] / done, 1) if done else 0.0,
+            "avg_handle_ms": round(counters["handle_ms_total"] / done, 1) if done else 0.0,
+        }
+
+    def shutdown(self, timeout=WEBHOOK_DRAIN_TIMEOUT):
+        """Stops accepting updates and waits up to timeout seconds for the queued ones and their replies; returns True if drained."""
+        with self._lock:
+            self.accepting = False
+            started = bool(self.threads)
+        deadline = time.monotonic() + timeout
+        if started:
+            while any(worker_queue.unfinished_tasks for worker_queue in self.queues): # Counts taken updates until task_done()
+                if time.monotonic() >= deadline:
+                    logging.warning("Shutdown with %d updates still queued.", self.depth())
+                    return False
+                time.sleep(0.1)
+        return DISPATCHER.flush(timeout=max(0.0, deadline - time.monotonic()))
+
+
+UPDATE_QUEUE = None # The UpdateWorkerPool, once start_update_queue() created it
+
+
+def start_update_queue(handler):
+    """Creates UPDATE_QUEUE for handler and drains it at exit."""
+    global UPDATE_QUEUE
+    UPDATE_QUEUE = UpdateWorkerPool(handler)
+    atexit.register(UPDATE_QUEUE.shutdown)
+    return UPDATE_QUEUE
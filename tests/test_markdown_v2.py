@@ -0,0 +1,44 @@
+import pytest
+
+from api.markdown_v2 import MarkdownV2Stream
+
+
+def convert(*chunks):
+    formatter = MarkdownV2Stream()
+    for chunk in chunks:
+        formatter.feed(chunk)
+    formatter.finish()
+    return formatter.render()
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("**bold** and *italic*", "*bold* and _italic_"),
+    ("***x*** y", "*_x_* y"),
+    ("*a **b***", "_a *b*_"),
+    ("*a**b*", "_a*b*_"),
+    ("**a *b** c", "*a _b_* c"),
+    ("~~s **b~~ c", "~s *b*~ c"),
+    ("# Title **x**\ntext", "*Title x*\ntext"),
+    ("a * b = 2.5!", "a \\* b \\= 2\\.5\\!"),
+    ("`x_y` and ```py\nprint(1)\n```", "`x_y` and ```py\nprint(1)\n```"),
+])
+def test_converts_markup(text, expected):
+    assert convert(text) == expected
+
+
+@pytest.mark.parametrize("text", ["***x*** y", "*a **b*** c", "**a *b** c*", "# H\n- item `code` ~~gone~~"])
+def test_same_output_for_any_split(text):
+    whole = convert(text)
+    for split in range(1, len(text)):
+        assert convert(text[:split], text[split:]) == whole
+
+
+def test_cut_closes_and_reopens_markup():
+    formatter = MarkdownV2Stream()
+    formatter.feed("**" + "word " * 20 + "**")
+    formatter.finish()
+    first, _ = formatter.cut(40)
+    rest = formatter.render()
+    assert len(first) <= 40
+    assert first.startswith("*") and first.endswith("*")
+    assert rest.startswith("*") and rest.endswith("*")
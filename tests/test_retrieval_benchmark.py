@@ -0,0 +1,26 @@
+import pytest
+
+from api.benchmark_retrieval import ENGINES, load_cases, run_engine
+from api.config import CONTEXT_MAX_CHARS
+
+TOP_K = 5
+# Measured on the shipped indexes: recall@5 0.653, hit@5 0.968 (30 of 31 cases); one lost case costs 0.032 hit@5
+MIN_RECALL = 0.63
+MIN_HIT = 0.93
+
+
+@pytest.fixture(scope="module")
+def bm25_metrics():
+    return run_engine(ENGINES["bm25"], load_cases(), top_k=TOP_K, repeat=1)
+
+
+def test_bm25_recall(bm25_metrics):
+    assert bm25_metrics[f"recall@{TOP_K}"] >= MIN_RECALL
+
+
+def test_bm25_hit_rate(bm25_metrics):
+    assert bm25_metrics[f"hit@{TOP_K}"] >= MIN_HIT
+
+
+def test_bm25_context_fits_budget(bm25_metrics):
+    assert bm25_metrics["max_context_chars"] <= CONTEXT_MAX_CHARS